@@ -0,0 +1,254 @@
+"""
+CPU micro-benchmarks of the ODM hot paths.
+No database is needed: every benchmark runs on synthetic models and
+documents, so the numbers measure the ODM overhead alone.
+
+Usage:
+    python benchmarks/bench_odm.py                  # compare with baseline.json
+    python benchmarks/bench_odm.py --save           # store a new baseline
+    python benchmarks/bench_odm.py --quick          # small result sets only
+    python benchmarks/bench_odm.py --only dict_rep  # benchmarks containing a name
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+from bson.objectid import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from odm import BaseModel  # noqa: E402
+from odm.data_types import Relations, Types  # noqa: E402
+from odm.dates import DATEUTIL, ISO  # noqa: E402
+from odm.json_encoder import get_json_encoder  # noqa: E402
+from odm.serializers import ODMSerializer  # noqa: E402
+from odm.validators import BaseValidator, JsonSchemaValidator, validate_once  # noqa: E402
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+FIELD_SIZES = (10, 50, 200)
+RESULT_SIZES = (1000, 100000)
+QUICK_RESULT_SIZES = (1000,)
+# wider models only use the small result set, 100k documents of 200 fields do not fit in memory
+LARGE_RESULT_MAX_FIELDS = 10
+LARGE_RESULT_MIN_DOCS = 10000
+
+TYPE_CYCLE = (
+    Types.String,
+    Types.Integer,
+    Types.Double,
+    Types.ISODate,
+    Types.ObjectId,
+    Types.Boolean,
+    Types.ObjectIdList,
+    Types.Object,
+    Types.Array,
+)
+
+NOW = datetime(2020, 1, 1, 12, 30, 15, 123000)
+
+
+def raw_value(field_type, i):
+    if field_type == Types.String:
+        return 'value %d' % i
+    if field_type == Types.Integer:
+        return i
+    if field_type == Types.Double:
+        return i / 3.0
+    if field_type == Types.ISODate:
+        return NOW
+    if field_type == Types.ObjectId:
+        return ObjectId()
+    if field_type == Types.Boolean:
+        return bool(i % 2)
+    if field_type == Types.ObjectIdList:
+        return [ObjectId(), ObjectId()]
+    if field_type == Types.Object:
+        return {'a': i, 'b': 'x'}
+    return [i, i + 1]
+
+
+def input_value(field_type, i):
+    """Values as received from an API, before preparse_fields/filter."""
+    value = raw_value(field_type, i)
+    if field_type == Types.ISODate:
+        return '2020-01-01T12:30:15.123Z'
+    if field_type == Types.ObjectId:
+        return str(value)
+    if field_type == Types.ObjectIdList:
+        return [str(v) for v in value]
+    return value
+
+
+def make_model(n_fields, relations=None):
+    fields = {'_id': Types.ObjectId}
+    for i in range(n_fields - 1):
+        fields['field_%d' % i] = TYPE_CYCLE[i % len(TYPE_CYCLE)]
+    attrs = {
+        'collection_name': 'bench_%d' % n_fields,
+        'fields': fields,
+        'protected_fields': ['field_0'],
+        'relations': relations or {},
+    }
+    return type('Bench%d' % n_fields, (BaseModel,), attrs)
+
+
+def make_doc(model, i, value=raw_value):
+    return {name: value(t, i) for name, t in model.fields.items()}
+
+
+Child = make_model(10)
+Parent = make_model(10, relations={
+    'child': {'type': Relations.belongsTo, 'model': Child, 'localKey': 'field_3', 'foreignKey': '_id'},
+    'children': {'type': Relations.hasMany, 'model': Child, 'localKey': '_id', 'foreignKey': 'field_3'},
+})
+
+
+def validate_and_coerce(params, rules, rule_set):
+    validator = BaseValidator(params)
+    validator.rules = rules
+    return validator.validate_and_coerce(rule_set)
+
+
+def measure(fn, min_time=0.2, repeat=3):
+    """Best seconds per call of fn."""
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def benchmarks(result_sizes):
+    cases = dict()
+
+    for n_fields in FIELD_SIZES:
+        model_cls = make_model(n_fields)
+        model = model_cls(None)
+        params = make_doc(model_cls, 1, input_value)
+        params['sort_desc'] = 'field_0,field_1'
+        cases['filter/%d_fields' % n_fields] = lambda m=model, p=params: m.filter(p)
+        cases['preparse_fields/%d_fields' % n_fields] = lambda m=model, p=params: m.preparse_fields(p)
+        rules = {BaseValidator.CREATE: BaseValidator.from_model(model_cls)}
+        cases['validate_and_coerce/%d_fields' % n_fields] = \
+            lambda p=params, r=rules: validate_and_coerce(p, r, BaseValidator.CREATE)
+
+        for n_docs in result_sizes:
+            if n_docs >= LARGE_RESULT_MIN_DOCS and n_fields > LARGE_RESULT_MAX_FIELDS:
+                continue
+            docs = [make_doc(model_cls, i) for i in range(n_docs)]
+            cases['dict_rep/%d_fields/%d_docs' % (n_fields, n_docs)] = \
+                lambda m=model, d=docs: [m.dict_rep(doc) for doc in d]
+
+    parent = Parent(None)
+    for n_docs in result_sizes:
+        docs = list()
+        for i in range(n_docs):
+            doc = make_doc(Parent, i)
+            doc['child'] = make_doc(Child, i)
+            doc['children'] = [make_doc(Child, i) for _ in range(3)]
+            docs.append(doc)
+        cases['dict_rep/nested_relations/%d_docs' % n_docs] = lambda d=docs: [parent.dict_rep(doc) for doc in d]
+        cases['convert/nested_relations/%d_docs' % n_docs] = lambda d=docs: [parent._convert(doc) for doc in d]
+        cases['json_response/dict_rep/%d_docs' % n_docs] = \
+            lambda d=docs: json.dumps([parent._convert(doc) for doc in d], cls=ODMSerializer).encode()
+        encode = get_json_encoder(Parent).plan().encode
+        cases['json_response/encoder/%d_docs' % n_docs] = \
+            lambda d=docs, e=encode: ('[' + ','.join(e(doc) for doc in d) + ']').encode()
+
+        serializable = [make_doc(Parent, i) for i in range(n_docs)]
+        cases['ODMSerializer/%d_docs' % n_docs] = lambda d=serializable: json.dumps(d, cls=ODMSerializer)
+
+    cases['sort_query'] = lambda: parent.sort_query({'sort_asc': 'field_0,field_1,field_2'}, tuples=True)
+    pagination = parent.paginate({'page': 2, 'page_size': 20})
+    cases['_relationships/pipeline'] = lambda: parent._relationships(
+        {'field_0': 'x'}, ['child', 'children'], [], pagination=pagination, params={'field_0': 'x'})
+
+    for label, value in [('iso', '2020-01-01T12:30:15.123Z'), ('offset', '2020-01-01T12:30:15-03:00')]:
+        cases['dates/%s/iso_codec' % label] = lambda v=value: ISO.parse(v)
+        cases['dates/%s/dateutil_codec' % label] = lambda v=value: DATEUTIL.parse(v)
+    cases['dates/format'] = lambda: ISO.format(NOW)
+
+    schema = {
+        'type': 'object',
+        'properties': {
+            'name': {'type': 'string', 'minLength': 1, 'description': 'nome inválido'},
+            'age': {'type': 'integer', 'minimum': 0},
+            'email': {'type': 'string', 'pattern': '^[^@]+@[^@]+$'},
+            'tags': {'type': 'array', 'items': {'type': 'string'}},
+            'owner': {'type': 'object_id'},
+        },
+        'required': ['name', 'age'],
+    }
+    validator = JsonSchemaValidator(schema)
+    instance = {'name': 'john', 'age': 30, 'email': 'john@doe.com', 'tags': ['a', 'b'], 'owner': ObjectId()}
+    cases['JsonSchemaValidator.validate'] = lambda: validator.validate(instance)
+    compiled = JsonSchemaValidator(schema, compiled=True)
+    cases['JsonSchemaValidator.validate/compiled'] = lambda: compiled.validate(instance)
+    cases['validate_once'] = lambda: validate_once(instance, schema)
+
+    return cases
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--quick', action='store_true', help='only use the small result sets')
+    parser.add_argument('--only', default='', help='run the benchmarks whose name contains this text')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='relative slowdown over the baseline reported as a regression')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file')
+    args = parser.parse_args(argv)
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = dict(baseline) if args.save else dict()
+    regressions = list()
+    for name, fn in benchmarks(QUICK_RESULT_SIZES if args.quick else RESULT_SIZES).items():
+        if args.only not in name:
+            continue
+        seconds = measure(fn)
+        results[name] = seconds
+        line = '{:<45} {:>12.3f} ms'.format(name, seconds * 1000)
+        if name in baseline:
+            ratio = seconds / baseline[name]
+            line += '  {:>6.2f}x baseline'.format(ratio)
+            if ratio > 1 + args.threshold:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to', args.baseline)
+        return 0
+
+    if regressions:
+        print('{} regression(s) over {:.0%}: {}'.format(len(regressions), args.threshold, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
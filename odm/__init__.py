@@ -3,33 +3,125 @@ odm module.
 Basic odm functions.
 """
 
-import copy
+import asyncio
 from datetime import datetime
-import logging
+import functools
+import time
 
 from bson.objectid import ObjectId
-from pymongo import ReturnDocument
+from pymongo import ReplaceOne, ReturnDocument
 from pymongo.results import UpdateResult, DeleteResult
 
-from .data_types import Relations, Types
+from .cache import MISS, invalidate_collection, make_key
+from .codecs import MANY_RELATIONS, SKIP, ModelCodec, get_codec
+from .data_types import Relations, SearchModes, Strategies, Types
 from .exceptions import DocumentNotFound
-from dateutil.parser import parse as date_parser
-from dateutil import tz
+from .indexes import index_keys, index_model, recommended_indexes
+from .instrumentation import current_event, instrumented, server_call, timed_cursor
+from .json_encoder import dumps_json, get_json_encoder
+from .keyset import decode_token, encode_token, keyset_match, keyset_sort, sort_values
+from .session import current_session, session
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return value
+    return [value]
+
+
+def _relation_tree(paths) -> dict:
+    # groups relation paths by their first relation: ["a", "a.b.c"] => {"a": ["b.c"]}
+    tree = dict()
+    for path in paths:
+        name, _, rest = path.partition('.')
+        nested = tree.setdefault(name, list())
+        if rest and rest not in nested:
+            nested.append(rest)
+    return tree
+
+
+def _array_expr(expr):
+    # aggregation expression of a value as a list, missing values as an empty list
+    return {"$let": {
+        "vars": {"value": {"$ifNull": [expr, []]}},
+        "in": {"$cond": [{"$isArray": "$$value"}, "$$value", ["$$value"]]}
+    }}
+
+
+def _scalar_key(model, key: str) -> bool:
+    # keys declared with a type that is never a list, matched by $expr $eq in lookups
+    return key == "_id" or model.fields.get(key) not in (None, Types.ObjectIdList, Types.Array)
+
+
+def _project_sort_keys(aggregation: list, sort: dict) -> tuple:
+    # keeps the sort keys through the top level $project stages, the next keyset token is read from them;
+    # returns the new aggregation and the keys the last $project would have dropped
+    keys = [key.split('.')[0] for key in sort]
+    stages, added = list(), set()
+    for stage in aggregation:
+        project = stage.get("$project")
+        if project is not None:
+            added = {key for key in keys if key not in project}
+            if added:
+                stage = {"$project": dict(project, **{key: True for key in added})}
+        stages.append(stage)
+    return stages, added
+
+
+def _select_local_keys(relations: dict, fields: list, batched: list) -> tuple:
+    # the batch strategy reads the local keys of its relations, even when a field selection leaves them out;
+    # returns the new selection and the keys to drop once the relations are loaded
+    tree = _relation_tree(batched)
+    keys = [relations[name]["localKey"] for name in tree]
+    added = {key for key in keys if key not in fields and key != "_id" and key not in tree}
+    return list(fields) + [key for key in keys if key not in fields], added
+
+
+def _drop_keys(doc: dict, keys: set) -> dict:
+    for key in keys:
+        doc.pop(key, None)
+    return doc
+
+
+def _prefix_query(query: dict, prefix: str) -> dict:
+    prefixed = dict()
+    for key, value in query.items():
+        if key in ('$or', '$and', '$nor'):
+            prefixed[key] = [_prefix_query(q, prefix) for q in value]
+        elif key.startswith('$'):
+            msg = 'operador não suportado em change streams {}'.format(key)
+            raise NotImplementedError(msg)
+        else:
+            prefixed[prefix + key] = value
+    return prefixed
+
 
 class BaseModel:
     """
     BaseModel class.
     It serves as a base model class for all child models.
 
+    :method codec(): Returns the cached field codec of the model class.
     :method filter(params): Filters a query.
     :method preparseFields(params): Preparses the input fields.
     :method dict_rep(params): Iterates through a query and checks it.
-    :method paginate(params): Paginates a result.
-    :method find(params, force_single_result, relations, force_fetch_protected_fields): Finds a query.
-    :method first(params, relations): Returns the first find of a query.
-    :method paged(params, pagination, relations, force_fetch_protected_fields): Pages a result.
-    :method remove(_id): Removes a result.
+    :method paginate(params, search): Paginates a result.
+    :method find(params, force_single_result, relations, force_fetch_protected_fields, fields, strategy):
+        Finds a query.
+    :method stream(params, relations, force_fetch_protected_fields, batch_size, fields, strategy):
+        Iterates over a query.
+    :method first(params, relations, fields, strategy): Returns the first find of a query.
+    :method paged(params, pagination, relations, force_fetch_protected_fields, fields, mode, after, strategy):
+        Pages a result.
+    :method watch(params, relations, force_fetch_protected_fields, resume_after): Subscribes to changes.
+    :method remove(_id, force): Removes a result.
+    :method remove_many(params, force): Removes every result of a query.
     :method save(bus_object): Saves a result.
+    :method save_many(bus_objects, ordered, batch_size): Saves many results with batched writes.
+    :method recommended_indexes(): Lists declared and derived indexes.
+    :method ensure_indexes(recommended): Creates the indexes of the model.
     :method _clear_protected_fields(model, result, force_fetch_protected_fields): Cleans the protected fields.
     :method _relationships(criteria, keyArray, force_fetch_protected_fields): Check the relationships.
     """
@@ -41,6 +133,19 @@ class BaseModel:
     PRE_DELETE = 'pre_delete'
     POST_DELETE = 'post_delete'
 
+    HOOK_METHODS = {
+        PRE_CREATE: 'pre_create',
+        POST_CREATE: 'post_create',
+        PRE_UPDATE: 'pre_update',
+        POST_UPDATE: 'post_update',
+        PRE_DELETE: 'pre_delete',
+        POST_DELETE: 'post_delete',
+    }
+    PRE_HOOKS = (PRE_CREATE, PRE_UPDATE, PRE_DELETE)
+
+    PAGED_FACET = 'facet'
+    PAGED_CONCURRENT = 'concurrent'
+
     db = None
     fields = dict()
     collection_name = None
@@ -48,7 +153,20 @@ class BaseModel:
     relations = {}
     softDeletes = False
     hooks = list()
+    deferred_hooks = list()  # post hooks run by hook_dispatcher instead of inline
+    hook_dispatcher = None  # odm.hooks.HookDispatcher
     debug = False
+    indexes = []
+    search_modes = {}
+    default_search_mode = SearchModes.prefix
+    # collation of queries searching fields declared in SearchModes.prefix mode, case insensitive like substring
+    search_collation = {"locale": "pt", "strength": 2}
+    # $lookup with localField/foreignField and a pipeline, set True on MongoDB 5.0+ servers
+    concise_lookups = False
+    paged_mode = PAGED_FACET
+    cache = None  # odm.cache.QueryCache caching the results of find, first and paged
+    date_codec = None  # odm.dates.DateCodec of the ISODate fields, odm.dates.ISO if None
+    instrumentation = list()  # odm.instrumentation.Instrumentation listeners of the operations
 
     def __init__(self, db):
         self.db = db
@@ -71,12 +189,87 @@ class BaseModel:
     async def post_update(self, model_id, saved):
         pass
 
-    def sort_query(self, params: dict, tuples=False):
+    async def pre_create_many(self, count):
+        for _ in range(count):
+            await self.pre_create()
+
+    async def post_create_many(self, model_ids, saved):
+        for model_id, doc in zip(model_ids, saved):
+            await self.post_create(model_id, doc)
+
+    async def pre_update_many(self, model_ids):
+        for model_id in model_ids:
+            await self.pre_update(model_id)
+
+    async def post_update_many(self, model_ids, saved):
+        for model_id, doc in zip(model_ids, saved):
+            await self.post_update(model_id, doc)
+
+    async def pre_delete_many(self, model_ids):
+        for model_id in model_ids:
+            await self.pre_delete(model_id)
+
+    async def post_delete_many(self, model_ids, softDeletes):
+        for model_id in model_ids:
+            await self.post_delete(model_id, None, softDeletes)
+
+    async def _run_hooks(self, hook: str, args_list: list, many: bool = False):
+        """
+        Runs a hook once per arguments tuple, inline or, for post hooks
+        listed in deferred_hooks, through the hook_dispatcher.
+
+        :param hook: Hook name, like POST_CREATE.
+        :param args_list: List of argument tuples.
+        :param many: Calls the *_many variant, for batch operations.
+        """
+        event = current_event()
+        start = time.perf_counter() if event is not None else None
+        try:
+            if hook in self.deferred_hooks and hook not in self.PRE_HOOKS and self.hook_dispatcher is not None:
+                for args in args_list:
+                    await self.hook_dispatcher.dispatch(self, hook, args)
+            else:
+                await self._call_hooks(hook, args_list, many)
+        finally:
+            if event is not None:
+                event.hook_time += time.perf_counter() - start
+
+    async def _call_hooks(self, hook: str, args_list: list, many: bool = False):
+        """
+        Calls a hook once per arguments tuple, or its *_many variant once for
+        all of them, even a single one.
+
+        :param hook: Hook name, like POST_CREATE.
+        :param args_list: List of argument tuples.
+        :param many: Calls the *_many variant, for batch operations.
+        """
+        if not many:
+            for args in args_list:
+                await getattr(self, self.HOOK_METHODS[hook])(*args)
+        elif hook == self.PRE_CREATE:
+            await self.pre_create_many(len(args_list))
+        elif hook == self.PRE_UPDATE:
+            await self.pre_update_many([a[0] for a in args_list])
+        elif hook == self.PRE_DELETE:
+            await self.pre_delete_many([a[0] for a in args_list])
+        elif hook == self.POST_CREATE:
+            await self.post_create_many([a[0] for a in args_list], [a[1] for a in args_list])
+        elif hook == self.POST_UPDATE:
+            await self.post_update_many([a[0] for a in args_list], [a[1] for a in args_list])
+        elif hook == self.POST_DELETE and all(a[1] is None and a[2] == args_list[0][2] for a in args_list):
+            await self.post_delete_many([a[0] for a in args_list], args_list[0][2])
+        else:
+            for args in args_list:
+                await getattr(self, self.HOOK_METHODS[hook])(*args)
+
+    def sort_query(self, params: dict, tuples=False, search: dict = None):
         """
         Generates SORT query according to pymongo standard.
+        Without sort params, text searches are sorted by relevance.
 
         :param params: Parameters to be added to the function.
         :param tuples: tuple list to be used for sorting => [(key, order)].
+        :param search: Query parameters telling text searches apart, params if None.
         :return: Sort query.
         """
 
@@ -95,7 +288,9 @@ class BaseModel:
             except Exception as e:
                 sort = params.get('sort')
 
-        if sort is None:
+        if sort is None and self._text_search(params if search is None else search):
+            sort_query = {"score": {"$meta": "textScore"}}
+        elif sort is None:
             sort_query = {"_id": 1}
         else:
             sort_query = {k: sort[k] for k in sort}
@@ -105,12 +300,72 @@ class BaseModel:
 
         return sort_query
     
+    def _text_search(self, params: dict) -> bool:
+        """
+        Tells if a query searches a field in SearchModes.text mode.
+
+        :param params: Parameters to be added to the function.
+        :return: Boolean value.
+        """
+        return SearchModes.text in self._search_modes(params)
+
+    def _collation_kwargs(self, params: dict) -> dict:
+        """
+        Returns the collation argument of the database commands of a query.
+        Searches on fields declared with SearchModes.prefix in search_modes are
+        ranges compared with search_collation, the collation of their index.
+        The collation applies to the whole command, so fields searched in the
+        default prefix mode are compared like any other field instead.
+
+        :param params: Parameters to be added to the function.
+        :return: Dict with the collation, empty if the query does not need one.
+        """
+        if self.search_collation and any(self.search_modes.get(name) == SearchModes.prefix
+                                         for name in self._searched_fields(params)):
+            return {"collation": self.search_collation}
+        return {}
+
+    def _search_modes(self, params: dict) -> set:
+        """
+        Lists the search modes of the text_fields of a query.
+
+        :param params: Parameters to be added to the function.
+        :return: Set of SearchModes values.
+        """
+        return {self.search_modes.get(name, self.default_search_mode) for name in self._searched_fields(params)}
+
+    def _searched_fields(self, params: dict) -> list:
+        """
+        Lists the text_fields of a query that are searched.
+
+        :param params: Parameters to be added to the function.
+        :return: List of field names.
+        """
+        text_fields = params.get('text_fields')
+        if not text_fields:
+            return list()
+        if type(text_fields) == str:
+            text_fields = self._split(text_fields)
+        fields = self.codec().fields
+        return [name for name in text_fields if name in params and fields.get(name) == Types.String]
+
     def _split(self, string, sep: str=','):
         tokens = string.split(sep)
         tokens = [t.strip() for t in tokens]  # rm white spaces 
         tokens = list(filter(None, tokens))  # filter out empty strings
         return tokens
 
+    @classmethod
+    def codec(cls) -> ModelCodec:
+        """
+        Returns the field codec of the model class.
+        It is built on first use and cached on the class, so `fields` and
+        `relations` are expected to be fully declared by then.
+
+        :return: ModelCodec instance.
+        """
+        return get_codec(cls)
+
     def filter(self, params: dict) -> dict:
         """
         Filters a query.
@@ -119,98 +374,32 @@ class BaseModel:
         :return: Filtered query.
         """
         query = dict()
-        fields = self.fields
-        fields["created_at"] = Types.ISODate
-        fields["updated_at"] = Types.ISODate
+        codec = self.codec()
+        fields = codec.fields
+        filters = codec.filters
         text_fields = params.get('text_fields', [])
         if type(text_fields) == str:
             text_fields = self._split(text_fields)
+        search_terms = list()
         for name in params:
             param = params[name]
             if fields.get(name) is not None:
-                if fields[name] == Types.ObjectId:
-                    if type(param) == str:
-                        query[name] = ObjectId(param)
-                    elif type(param) == dict:
-                        for k in param:
-                            if k == "$in":
-                                param["$in"] = [ObjectId(_id)
-                                                for _id in param["$in"]]
-                            elif k == "$ne":
-                                param["$ne"] = ObjectId(param["$ne"])
-                            else:
-                                msg = 'operador não implementado {}'.format(k)
-                                raise NotImplementedError(msg)
-                        query[name] = param
-                        
-                    elif type(param) == ObjectId:
-                        query[name] = param
-                    else:
-                        raise NotImplementedError
-
-                elif fields[name] == Types.ObjectIdList:
-                    if type(param) == list:
-                        query[name] = {'$all': [ObjectId(s) for s in param]}
-                    elif type(param) == str:
-                        query[name] = {'$all': [ObjectId(s) for s in self._split(param)]}
-                    elif type(param) == ObjectId:
-                        query[name] = {'$all': [param]}
-                    elif type(param) == dict:
-                        for k in param:
-                            if k == "$in":
-                                param["$in"] = [ObjectId(_id)
-                                                for _id in param["$in"]]
-                            elif k == "$ne":
-                                param["$ne"] = ObjectId(param["$ne"])
-                            else:
-                                msg = 'operador não implementado {}'.format(k)
-                                raise NotImplementedError(msg)
-                        query[name] = param
-
-                elif fields[name] == Types.ISODate:
-                    if isinstance(param, str):
-                        query[name] = date_parser(param)
-                    else:
-                        if isinstance(param, dict):
-                            n_param = dict()
-                            for k, v in param.items():
-                                if k in ["$gt", "$gte", "$lt", "$lte", "$ne", "$eq"]:
-                                    if isinstance(v, str):
-                                        n_param[k] = date_parser(param)
-                                    elif isinstance(v, datetime):
-                                        n_param[k] = v
-                                    else:
-                                        msg = 'Tipo {} não suportado para o campo {}'.format(type(v), name)
-                                        raise Exception (msg)
-                            query[name] = n_param
-                        else:
-                            query[name] = param
-                elif fields[name] == Types.Object:
-                    query[name] = param
-
-                elif fields[name] == Types.Array:
-                    query[name] = param
-
-                elif fields[name] == Types.Integer:
-                    if not isinstance(param, int):
-                        query[name] = int(param)
-                    else:
-                        query[name] = param
-
-                elif fields[name] == Types.Double:
-                    query[name] = float(param)
-
-                elif fields[name] == Types.Boolean:
-                    query[name] = param
-
-                elif fields[name] == Types.String:
-                    if name in text_fields:
+                if fields[name] == Types.String and name in text_fields:
+                    mode = self.search_modes.get(name, self.default_search_mode)
+                    if mode == SearchModes.text:
+                        search_terms.append(str(param))
+                    elif mode == SearchModes.substring:
                         query[name] = {
                             "$regex": ".*" + str(param) + ".*",
                             "$options": "ig"
                         }
                     else:
-                        query[name] = param
+                        # U+FFFF sorts after every character, also in collations
+                        query[name] = {"$gte": str(param), "$lt": str(param) + "\uffff"}
+                elif filters[name] is not None:
+                    value = filters[name](param, name)
+                    if value is not SKIP:
+                        query[name] = value
             else:
                 reserved_names = [
                     "sort",
@@ -230,6 +419,9 @@ class BaseModel:
                     else:
                         query[name] = param
 
+        if search_terms:
+            query["$text"] = {"$search": " ".join(search_terms)}
+
         if params.get("$or"):
             query["$or"] = params.get("$or")
 
@@ -245,51 +437,17 @@ class BaseModel:
         :param params: Parameters to be added to the function.
         :return: A parsed field.
         """
-        query = dict()
-        fields = self.fields
-        fields["created_at"] = Types.ISODate
-        fields["updated_at"] = Types.ISODate
-        fields["deleted_at"] = Types.ISODate
-        for name in fields:
-            if params.get(name) is not None:
-                param = params.get(name)
-                if fields[name] == Types.ObjectId:
-                    query[name] = ObjectId(param)
-                elif fields[name] == Types.ObjectIdList:
-                    if type(param) == list:
-                        query[name] = [ObjectId(s) for s in param]
-                elif fields[name] == Types.ISODate:
-                    if isinstance(param, str):
-                        query[name] = date_parser(param)
-                    elif isinstance(param, datetime):
-                        query[name] = param
-                    else:
-                        raise Exception('wrong type [{}] for {}'.format(
-                            type(param),
-                            name
-                        ))
-
-                elif fields[name] == Types.Object:
-                    query[name] = param
-
-                elif fields[name] == Types.Array:
-                    query[name] = param
-
-                elif fields[name] == Types.Integer:
-                    query[name] = int(param)
+        return self.codec().encode(params)
 
-                elif fields[name] == Types.Double:
-                    query[name] = float(param)
-
-                elif fields[name] == Types.Boolean:
-                    query[name] = param
-
-                elif fields[name] == Types.String:
+    def _preparsed(self, params: dict) -> dict:
+        """
+        Keeps the model fields of already converted params.
 
-                    query[name] = str(param)
-                else:
-                    query[name] = param
-        return query
+        :param params: Parameters to be added to the function.
+        :return: Fields to be saved.
+        """
+        fields = self.codec().fields
+        return {k: v for k, v in params.items() if k in fields and v is not None}
 
     def dict_rep(self, params: dict) -> dict:
         """
@@ -298,67 +456,24 @@ class BaseModel:
         :param params: Parameters to be added to the function.
         :return: Iterated query.
         """
-        query = dict()
-        fields = self.fields
-        fields["created_at"] = Types.ISODate
-        fields["updated_at"] = Types.ISODate
-        fields["deleted_at"] = Types.ISODate
-        for name in fields:
-            if params.get(name) is not None:
-                param = params.get(name)
-                if fields[name] == Types.ObjectId:
-                    query[name] = str(param)
-                elif fields[name] == Types.ObjectIdList:
-                    query[name] = [str(s) for s in param]
-                elif fields[name] == Types.ISODate:
-                    if isinstance(param, str):
-                        query[name] = date_parser(param)
-                    else:
-                        query[name] = param.isoformat() + 'Z'
+        return self.codec().decode(params, self.db)
 
-                elif fields[name] == Types.Object:
-                    query[name] = param
+    dict_rep._codec_dict_rep = True
 
-                elif fields[name] == Types.Array:
-                    query[name] = param
-
-                elif fields[name] == Types.Integer:
-                    query[name] = int(param)
-
-                elif fields[name] == Types.Double:
-                    query[name] = float(param)
-
-                elif fields[name] == Types.Boolean:
-                    query[name] = param
-
-                elif fields[name] == Types.String:
-                    query[name] = str(param)
-                else:
-                    query[name] = param
-
-        for name in self.relations:
-            if params.get(name) is not None:
-                m = self.relations[name]["model"](self.db)
-                if self.relations[name]["type"] in [Relations.hasManyLocally, Relations.hasMany, Relations.belongsToMany]:
-                    items = params[name]
-                    query[name] = []
-                    for k, item in enumerate(items):
-                        query[name].append(m.dict_rep(item))
-                else:
-                    query[name] = m.dict_rep(params[name])
-
-        return query
-
-    def paginate(self, params: dict) -> dict:
+    def paginate(self, params: dict, search: dict = dict()) -> dict:
         """
         Paginates a result.
 
         :param params: Parameters to be added to the function.
+        :param search: Query parameters, text searches are sorted by relevance by default.
         :return: Paginated result.
         """
         pagination = {}
 
-        sort_query = self.sort_query(params)
+        if params.get('after') is not None:
+            # keyset pages seek on document values, the relevance score is not one
+            search = dict()
+        sort_query = self.sort_query(params, search=search or params)
 
         pagination["sort"] = sort_query
 
@@ -372,10 +487,19 @@ class BaseModel:
         else:
             pagination["page_size"] = 50
 
+        # keyset mode: an empty token asks for the first page
+        if params.get('after') is not None:
+            pagination["sort"] = keyset_sort(sort_query)
+            pagination["page"] = 0
+            if params['after']:
+                pagination["after"] = decode_token(params['after'], len(pagination["sort"]))
+            pagination["keyset"] = True
+
         return pagination
 
+    @instrumented('find')
     async def find(self, params: dict, force_single_result: bool = False, relations: list = list(),
-                   force_fetch_protected_fields: list = list()):
+                   force_fetch_protected_fields: list = list(), fields: list = None, strategy: str = None):
         """
         Finds a query.
 
@@ -383,73 +507,517 @@ class BaseModel:
         :param force_single_result: Boolean value.
         :param relations: List of relations.
         :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param fields: List of fields to be fetched, all of them if None.
+        :param strategy: Strategies value used for every relation, overriding their own.
         :return: Query to be found.
         """
+        limit = 1 if force_single_result else None
+        results = self._identity_lookup(params, relations, force_fetch_protected_fields, fields)
+        if results is MISS and self.cache is None:
+            results = [doc async for doc in self.stream(params, relations, force_fetch_protected_fields,
+                                                          fields=fields, strategy=strategy, limit=limit)]
+        elif results is MISS:
+            key = self._cache_key('find', params, self.sort_query(params, tuples=True), relations,
+                                  force_fetch_protected_fields, fields, limit)
+            results = self.cache.get(key)
+            if results is MISS:
+                results = [doc async for doc in self.stream(params, relations, force_fetch_protected_fields,
+                                                              fields=fields, strategy=strategy, limit=limit)]
+                self.cache.set(key, results, self._cache_collections(params, relations))
+
+        # an empty result has always been returned as None
+        if not results:
+            return None
+
+        if force_single_result:
+            return results[0]
+        return results
+
+    async def stream(self, params: dict, relations: list = list(), force_fetch_protected_fields: list = list(),
+                     batch_size: int = None, fields: list = None, strategy: str = None, limit: int = None):
+        """
+        Iterates over a query one document at a time.
+        Documents are converted and cleaned as they arrive from the cursor, so
+        memory does not grow with the size of the result. Relations loaded with
+        the batch strategy are fetched once per batch_size documents.
+
+        :param params: Parameters to be added to the function.
+        :param relations: List of relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param batch_size: Number of documents fetched per cursor batch.
+        :param fields: List of fields to be fetched, all of them if None.
+        :param strategy: Strategies value used for every relation, overriding their own.
+        :param limit: Maximum number of documents, all of them if None.
+        :return: Async iterator of documents.
+        """
+        convert = functools.partial(self._convert, force_fetch_protected_fields=force_fetch_protected_fields)
+        async for doc in self._stream(params, relations, force_fetch_protected_fields, batch_size, fields, strategy,
+                                      limit, convert):
+            yield doc
+
+    @instrumented('find_json')
+    async def find_json(self, params: dict, force_single_result: bool = False, relations: list = list(),
+                        force_fetch_protected_fields: list = list(), fields: list = None,
+                        strategy: str = None) -> bytes:
+        """
+        Finds a query and returns it as JSON.
+        Documents are written straight from the database values: the result
+        is json.dumps(find(...), cls=ODMSerializer, separators=(',', ':')),
+        without building the converted documents. The result cache and the
+        identity map are not used.
+
+        :param params: Parameters to be added to the function.
+        :param force_single_result: Boolean value.
+        :param relations: List of relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param fields: List of fields to be fetched, all of them if None.
+        :param strategy: Strategies value used for every relation, overriding their own.
+        :return: UTF-8 JSON document, array of documents or null.
+        """
+        limit = 1 if force_single_result else None
+        results = [doc async for doc in self._stream(params, relations, force_fetch_protected_fields, None, fields,
+                                                      strategy, limit, self._json_encode(force_fetch_protected_fields))]
+        if not results:
+            return b'null'
+        if force_single_result:
+            return results[0].encode()
+        return ('[' + ','.join(results) + ']').encode()
+
+    async def stream_json(self, params: dict, relations: list = list(), force_fetch_protected_fields: list = list(),
+                          batch_size: int = None, fields: list = None, strategy: str = None):
+        """
+        Iterates over a query as chunks of a JSON array, one document per
+        chunk, to be written to a response as they arrive.
+
+        :param params: Parameters to be added to the function.
+        :param relations: List of relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param batch_size: Number of documents fetched per cursor batch.
+        :param fields: List of fields to be fetched, all of them if None.
+        :param strategy: Strategies value used for every relation, overriding their own.
+        :return: Async iterator of UTF-8 bytes.
+        """
+        separator = '['
+        async for doc in self._stream(params, relations, force_fetch_protected_fields, batch_size, fields, strategy,
+                                      None, self._json_encode(force_fetch_protected_fields)):
+            yield (separator + doc).encode()
+            separator = ','
+        yield b'[]' if separator == '[' else b']'
+
+    def _json_encode(self, force_fetch_protected_fields: list = list()):
+        """
+        Returns the function writing a database document as JSON text.
+
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :return: Callable receiving a document.
+        """
+        plan = get_json_encoder(type(self)).plan(force_fetch_protected_fields)
+        if plan is not None:
+            return plan.encode
+        return lambda doc: dumps_json(self._convert(doc, force_fetch_protected_fields))
+
+    async def _stream(self, params: dict, relations: list, force_fetch_protected_fields: list, batch_size: int,
+                      fields: list, strategy: str, limit: int, convert):
+        lookups, batched = self._relation_strategies(relations, strategy, params, self.sort_query(params))
+        identity_map = None
+        if not lookups and fields is None and (limit or "_id" in params):
+            # only by-id and limited reads are kept, a streamed export would stay in memory for the session
+            identity_map = current_session()
+        hidden = self._hidden_fields(force_fetch_protected_fields)
+        local_keys = set()
+        if batched and fields:
+            fields, local_keys = _select_local_keys(self.relations, fields, batched)
+
+        cursor = self._find_cursor(params, lookups, force_fetch_protected_fields, batch_size, fields, limit)
+        if not batched:
+            async for doc in timed_cursor(cursor):
+                if identity_map is not None:
+                    identity_map.put(self.collection_name, doc, hidden)
+                yield convert(doc)
+            return
+
+        chunk_size = batch_size or 100
+        chunk = list()
+        async for doc in timed_cursor(cursor):
+            if identity_map is not None:
+                identity_map.put(self.collection_name, doc, hidden)
+            chunk.append(doc)
+            if len(chunk) >= chunk_size:
+                await self._load_relations(chunk, batched, force_fetch_protected_fields)
+                for item in chunk:
+                    yield convert(_drop_keys(item, local_keys))
+                chunk = list()
+        if chunk:
+            await self._load_relations(chunk, batched, force_fetch_protected_fields)
+            for item in chunk:
+                yield convert(_drop_keys(item, local_keys))
+
+    async def watch(self, params: dict = dict(), relations: list = list(),
+                    force_fetch_protected_fields: list = list(), resume_after: dict = None,
+                    soft_deletes_as_deletes: bool = True, batch_size: int = None):
+        """
+        Subscribes to the changes of documents matching a query (MongoDB
+        change streams, replica sets only).
+        Each event carries its operation, the _id, the converted document
+        and the resume token to restart the subscription from. With
+        softDeletes, setting deleted_at is reported as a delete event.
+
+        :param params: Parameters to be added to the function.
+        :param relations: List of relations, loaded with the batch strategy.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param resume_after: Resume token of the last processed event.
+        :param soft_deletes_as_deletes: Reports soft deletes as delete events.
+        :param batch_size: Number of events fetched per batch.
+        :return: Async iterator of events.
+        """
+        pipeline = self._watch_pipeline(params, force_fetch_protected_fields)
+        kwargs = dict(full_document='updateLookup', **self._collation_kwargs(params))
+        if resume_after is not None:
+            kwargs['resume_after'] = resume_after
+        if batch_size:
+            kwargs['batch_size'] = batch_size
+
+        soft = self.softDeletes and soft_deletes_as_deletes
+        async with self.db[self.collection_name].watch(pipeline, **kwargs) as stream:
+            async for change in stream:
+                operation = change['operationType']
+                doc = change.get('fullDocument')
+                if soft and doc is not None and doc.get('deleted_at') is not None:
+                    updated = change.get('updateDescription', {}).get('updatedFields', {})
+                    if 'deleted_at' in updated:
+                        operation = 'delete'
+                    elif not params.get('with_trashed', False):
+                        continue
+
+                if doc is not None:
+                    if relations:
+                        await self._load_relations([doc], relations, force_fetch_protected_fields)
+                    doc = self._convert(doc, force_fetch_protected_fields)
+
+                yield {
+                    "operation": operation,
+                    "_id": str(change.get('documentKey', {}).get('_id')),
+                    "document": doc,
+                    "resume_token": change['_id'],
+                }
+
+    def _watch_pipeline(self, params: dict, force_fetch_protected_fields: list = list()) -> list:
+        """
+        Translates a query into a change stream pipeline on fullDocument.
+        Deletes carry no document, so they are always let through.
+
+        :param params: Parameters to be added to the function.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :return: Change stream pipeline.
+        """
+        criteria = self.filter(dict(params, with_trashed=True))
+        pipeline = [{"$match": {"$or": [
+            {"operationType": "delete"},
+            _prefix_query(criteria, 'fullDocument.'),
+        ]}}]
+
+        hidden = {"fullDocument." + p: False for p in self._hidden_fields(force_fetch_protected_fields)}
+        if hidden:
+            pipeline.append({"$project": hidden})
+        return pipeline
+
+    def _hidden_fields(self, force_fetch_protected_fields: list = list()) -> frozenset:
+        """
+        Lists the protected fields left out of a query.
+
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :return: Set of field names.
+        """
+        return frozenset(p for p in self.protected_fields if p not in force_fetch_protected_fields)
+
+    def _identity_lookup(self, params: dict, relations: list, force_fetch_protected_fields: list,
+                         fields: list = None):
+        """
+        Serves a find by _id from the identity map of the active session.
+
+        :param params: Parameters to be added to the function.
+        :param relations: List of relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param fields: List of fields to be fetched, all of them if None.
+        :return: List of results, MISS when the database must be queried.
+        """
+        identity_map = current_session()
+        if identity_map is None or relations or fields or set(params) - {'_id', 'with_trashed'}:
+            return MISS
+
+        _id = self.filter(params).get('_id')
+        if _id is None or isinstance(_id, (dict, list)):
+            return MISS
+
+        doc = identity_map.get(self.collection_name, _id, self._hidden_fields(force_fetch_protected_fields))
+        if doc is None:
+            return MISS
+        if doc.get('deleted_at') is not None and not params.get('with_trashed', False):
+            return []
+        return [self._convert(doc, force_fetch_protected_fields)]
+
+    def _cache_key(self, operation: str, params: dict, *parts) -> str:
+        """
+        Builds the result cache key of a query from its normalized criteria.
+
+        :param operation: Name of the cached operation.
+        :param params: Parameters to be added to the function.
+        :param parts: Other values changing the result, like sort and relations.
+        :return: Cache key.
+        """
+        return make_key(self.collection_name, operation, self.filter(params), self._relation_filters(params), *parts)
+
+    def _cache_collections(self, params: dict, relations: list) -> set:
+        """
+        Lists the collections a cached result depends on.
+
+        :param params: Parameters used for dot notation filters on relations.
+        :param relations: List of relations.
+        :return: Set of collection names.
+        """
+        tree = _relation_tree(relations)
+        for key in self._relation_filters(params):
+            tree.setdefault(key.split('.')[0], list())
+        collections = {self.collection_name}
+        for name, nested in tree.items():
+            if name in self.relations:
+                model = self.relations[name]["model"]
+                collections.add(model.collection_name)
+                if nested:
+                    collections.update(model(self.db)._cache_collections(dict(), nested))
+        return collections
+
+    def _relation_strategies(self, relations: list, strategy: str = None, params: dict = dict(),
+                             sort: dict = dict()):
+        """
+        Splits the requested relations between $lookup and batch loading.
+        Relations filtered or sorted by dot notation are always joined with
+        $lookup, since the server needs them to select documents. Nested
+        relation paths follow the strategy of their first relation.
+
+        :param relations: List of relations.
+        :param strategy: Strategies value used for every relation, overriding their own.
+        :param params: Parameters used for dot notation filters on relations.
+        :param sort: Sort query.
+        :return: Tuple with the lookup relations and the batched relations.
+        """
+        required = {key.split('.')[0] for key in self._relation_filters(params)}
+        required.update(key.split('.')[0] for key in sort if '.' in key)
+
+        lookups, batched = list(), list()
+        for path in relations:
+            name = path.split('.')[0]
+            relation = self.relations.get(name)
+            chosen = strategy or (relation or {}).get("strategy", Strategies.lookup)
+            if relation is not None and chosen == Strategies.batch and name not in required:
+                batched.append(path)
+            else:
+                lookups.append(path)
+        return lookups, batched
+
+    async def _load_relations(self, docs: list, relations: list, force_fetch_protected_fields: list = list()):
+        """
+        Loads relations of raw documents with one $in query per relation.
+        The relations are loaded concurrently and attached to the documents;
+        nested relation paths (like "city.country") are then loaded level by
+        level on the related documents.
+
+        :param docs: Raw documents.
+        :param relations: List of relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        """
+        await asyncio.gather(*[
+            self._load_relation(docs, name, force_fetch_protected_fields, nested)
+            for name, nested in _relation_tree(relations).items() if name in self.relations
+        ])
 
+    async def _load_relation(self, docs: list, name: str, force_fetch_protected_fields: list = list(),
+                             nested: list = list()):
+        """
+        Loads a relation of raw documents with a single $in query, mirroring
+        the results of the $lookup built by _relationships.
+
+        :param docs: Raw documents.
+        :param name: Relation name.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param nested: Relation paths of the related model to load as well.
+        """
+        relation = self.relations[name]
+        model = relation["model"]
+        many = relation["type"] in MANY_RELATIONS
+        local_key = relation["localKey"]
+        if relation["type"] == Relations.hasManyLocally:
+            foreign_key = "_id"
+        else:
+            foreign_key = relation["foreignKey"]
+
+        hidden = frozenset(p for p in model.protected_fields
+                           if p not in force_fetch_protected_fields and p != foreign_key)
+        # stored documents would not come in the order of the relation sort
+        identity_map = current_session() if not relation.get("sort") else None
+
+        values = list()
+        related = list()
+        seen = set()
+        for doc in docs:
+            for value in _as_list(doc.get(local_key)):
+                if value is None or value in seen:
+                    continue
+                seen.add(value)
+                known = None
+                if identity_map is not None and foreign_key == "_id":
+                    known = identity_map.get(model.collection_name, value, hidden)
+                if known is None:
+                    values.append(value)
+                elif known.get("deleted_at") is None:
+                    # nested relations are attached to a copy of the stored document
+                    related.append(dict(known) if nested else known)
+
+        if values:
+            query = {foreign_key: {"$in": values}, "deleted_at": {"$exists": False}}
+            projection = {p: False for p in hidden} or None
+            kwargs = dict()
+            if relation.get("sort"):
+                kwargs["sort"] = list(relation["sort"].items())
+            cursor = self.db[model.collection_name].find(query, projection, **kwargs)
+            async for item in timed_cursor(cursor):
+                if identity_map is not None:
+                    identity_map.put(model.collection_name, item, hidden)
+                related.append(item)
+
+        if nested and related:
+            await model(self.db)._load_relations(related, nested, force_fetch_protected_fields)
+
+        index = dict()
+        for item in related:
+            for value in _as_list(item.get(foreign_key)):
+                matches = index.setdefault(value, list())
+                if not matches or matches[-1] is not item:
+                    matches.append(item)
+
+        for doc in docs:
+            matches = list()
+            for value in _as_list(doc.get(local_key)):
+                for item in index.get(value, ()):
+                    if not any(item is m for m in matches):
+                        matches.append(item)
+            if many:
+                doc[name] = matches[:relation["limit"]] if relation.get("limit") else matches
+            elif matches:
+                doc[name] = matches[0]
+
+    def _find_cursor(self, params: dict, relations: list, force_fetch_protected_fields: list,
+                     batch_size: int = None, fields: list = None, limit: int = None):
+        """
+        Opens the cursor of a find query.
+
+        :param params: Parameters to be added to the function.
+        :param relations: List of relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param batch_size: Number of documents fetched per cursor batch.
+        :param fields: List of fields to be fetched, all of them if None.
+        :param limit: Maximum number of documents, all of them if None.
+        :return: Motor cursor.
+        """
         criteria = self.filter(params)
+        kwargs = self._collation_kwargs(params)
 
         if len(relations):
-            sort_query = self.sort_query(params)
-            ag = self._relationships(criteria, relations, force_fetch_protected_fields)
-            ag.insert(1, {'$sort': sort_query})
-
-            # Allows dot notation filters to be considered in queries
-            extra_filters = {}
-            for key, value in params.items():
-                if '.' in key:
-                    parts = key.split('.')
-                    rel_name = parts[0]
-                    rel_filter_field = parts[1]
-                    rel = self.relations.get(rel_name)
-                    if rel:
-                        rel_instance = rel['model'](self.db)
-                        rel_filter = rel_instance.filter({rel_filter_field: value})
-                        if rel_filter.get(rel_filter_field):
-                            extra_filters[key] = rel_filter.get(rel_filter_field)
-            if extra_filters:
-                ag.append({
-                    '$match': extra_filters
-                })
-            
+            window = {"sort": self.sort_query(params)}
+            if limit:
+                window["page_size"] = limit
+            ag = self._relationships(criteria, relations, force_fetch_protected_fields, pagination=window,
+                                     params=params, fields=fields)
+
             if self.debug:
                 print('aggregation', ag)
 
-            cursor = self.db[self.collection_name].aggregate(ag)
-            results = list()
-            async for doc in cursor:
-                results.append(self.dict_rep(doc))
-        else:
-            sort_query = self.sort_query(params, tuples=True)
-
-            cursor = self.db[self.collection_name].find(criteria, sort=sort_query)
-            results = list()
-            async for doc in cursor:
-                results.append(self.dict_rep(doc))
-
-        for result in results:
-            results = self._clear_protected_fields(
-                self, results, force_fetch_protected_fields)
-
-            for key in self.relations:
-                relation = self.relations[key]["model"](self.db)
-                if result.get(key) is not None:
-                    if type(result[key]) == list:
-                        for k, val in enumerate(result[key]):
-                            result[key][k] = self._clear_protected_fields(
-                                relation, val, force_fetch_protected_fields)
-                    else:
-                        result[key] = self._clear_protected_fields(
-                            relation, result[key], force_fetch_protected_fields)
+            if batch_size:
+                kwargs['batchSize'] = batch_size
+            return self.db[self.collection_name].aggregate(ag, **kwargs)
+
+        sort_query = self.sort_query(params, tuples=True)
+        if batch_size:
+            kwargs['batch_size'] = batch_size
+        projection = self._projection(fields, force_fetch_protected_fields)
+        if "$text" in criteria:
+            # servers before 4.4 only sort by relevance when the score is projected
+            projection = dict(projection or {}, score={"$meta": "textScore"})
+        if limit:
+            kwargs['limit'] = limit
+        return self.db[self.collection_name].find(criteria, projection, sort=sort_query, **kwargs)
+
+    def _projection(self, fields: list = None, force_fetch_protected_fields: list = list()):
+        """
+        Builds the projection sent to the database, so protected and unselected
+        fields never leave the server.
 
-            if len(results) == 0:
-                return results
+        :param fields: List of fields to be fetched, all of them if None.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :return: Projection dict, None when the whole document is needed.
+        """
+        hidden = [p for p in self.protected_fields if p not in force_fetch_protected_fields]
+        if fields:
+            return {f: True for f in fields if f not in hidden}
+        if hidden:
+            return {p: False for p in hidden}
+        return None
+
+    def _convert(self, doc: dict, force_fetch_protected_fields: list = list()) -> dict:
+        """
+        Converts a database document to its output representation.
 
-            if isinstance(results, list) and results and force_single_result:
-                # if (type(results)==list and len(results) and force_single_result):
-                return results[0]
-            else:
-                return results
+        :param doc: Document as returned by the database.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :return: Converted document without protected fields.
+        """
+        event = current_event()
+        start = time.perf_counter() if event is not None else None
+        result = self._clear_protected_fields(self, self.dict_rep(doc), force_fetch_protected_fields)
+        self._clear_related_protected_fields(self, result, force_fetch_protected_fields)
 
+        if event is not None:
+            event.conversion_time += time.perf_counter() - start
+        return result
+
+    @classmethod
+    def recommended_indexes(cls) -> dict:
+        """
+        Lists the declared indexes plus the ones derived from relations,
+        softDeletes and the default sorts.
+
+        :return: Dict of collection name to list of IndexModel.
+        """
+        declared = [index_model(spec) for spec in cls.indexes]
+        indexes = {cls.collection_name: declared}
+        for collection_name, derived in recommended_indexes(cls).items():
+            models = indexes.setdefault(collection_name, [])
+            known = {index_keys(m) for m in models}
+            for m in derived:
+                if index_keys(m) not in known:
+                    known.add(index_keys(m))
+                    models.append(m)
+        return {k: v for k, v in indexes.items() if v}
+
+    async def ensure_indexes(self, recommended: bool = True) -> dict:
+        """
+        Creates the indexes of the model.
+
+        :param recommended: Also creates the indexes derived from relations and softDeletes.
+        :return: Dict of collection name to list of created index names.
+        """
+        if recommended:
+            indexes = self.recommended_indexes()
+        else:
+            indexes = {self.collection_name: [index_model(spec) for spec in self.indexes]}
+
+        created = dict()
+        for collection_name, models in indexes.items():
+            if models:
+                created[collection_name] = await self.db[collection_name].create_indexes(models)
+        return created
+
+    @instrumented('count')
     async def count(self, params: dict):
         """
         Finds a query.
@@ -458,14 +1026,17 @@ class BaseModel:
         :return: Query to be found.
         """
 
+        kwargs = self._collation_kwargs(params)
         params = self.filter(params)
 
-        cursor = await self.db[self.collection_name].count(params)
+        cursor = await server_call(self.db[self.collection_name].count(params, **kwargs))
         return cursor
 
+    @instrumented('find_and_update')
     async def find_and_update(self, criteria, update):
 
         sort_query = self.sort_query(criteria, tuples=True)
+        kwargs = self._collation_kwargs(criteria)
         criteria = self.filter(criteria)
 
         set_query = update.get('$set', dict())
@@ -476,29 +1047,40 @@ class BaseModel:
 
 
         if self.PRE_UPDATE in self.hooks:
-            pre_doc = await self.db[self.collection_name].find_one(criteria, sort=sort_query)
-            await self.pre_update(str(pre_doc['_id']))
-
-        r = await self.db[self.collection_name].find_one_and_update(criteria, update,
-                                                                    sort=sort_query,
-                                                                    return_document=ReturnDocument.AFTER)
-
+            pre_doc = await server_call(self.db[self.collection_name].find_one(criteria, sort=sort_query,
+                                                                               **kwargs))
+            await self._run_hooks(self.PRE_UPDATE, [(str(pre_doc['_id']),)])
+
+        r = await server_call(self.db[self.collection_name].find_one_and_update(
+            criteria, update,
+            sort=sort_query,
+            return_document=ReturnDocument.AFTER,
+            **kwargs
+        ))
+        invalidate_collection(self.collection_name)
+        if r and current_session() is not None:
+            current_session().put(self.collection_name, r)
+
+        if not r:
+            return None
+
+        post_doc = self.dict_rep(r)
         if self.POST_UPDATE in self.hooks:
-            post_doc = self.dict_rep(r)
-            await self.post_update(post_doc.get('_id'), self.dict_rep(post_doc))
+            await self._run_hooks(self.POST_UPDATE, [(post_doc.get('_id'), dict(post_doc))])
 
-        if r:
-            return self.dict_rep(r)
+        return post_doc
 
-    def first(self, params: dict, relations: list = list()):
+    def first(self, params: dict, relations: list = list(), fields: list = None, strategy: str = None):
         """
         Returns the first find of a query.
 
         :param params: Parameters to be added to the function.
         :param relations: List of relations.
+        :param fields: List of fields to be fetched, all of them if None.
+        :param strategy: Strategies value used for every relation, overriding their own.
         :return: First result of found query.
         """
-        return self.find(params, True, relations)
+        return self.find(params, True, relations, fields=fields, strategy=strategy)
 
     def _clear_protected_fields(self, model, result, force_fetch_protected_fields: list = list()):
         """
@@ -521,100 +1103,278 @@ class BaseModel:
                     del result[p]
         return result
 
+    def _clear_related_protected_fields(self, model, result: dict, force_fetch_protected_fields: list = list()):
+        """
+        Cleans the protected fields of the related documents, at every level.
+
+        :param model: Model of the result.
+        :param result: Converted document.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        """
+        for key in model.relations:
+            if result.get(key) is not None:
+                relation = model.relations[key]["model"]
+                result[key] = self._clear_protected_fields(relation, result[key], force_fetch_protected_fields)
+                for item in _as_list(result[key]):
+                    self._clear_related_protected_fields(relation, item, force_fetch_protected_fields)
+
     def _relationships(self, criteria: dict, key_array: list, force_fetch_protected_fields: list = list(),
-                      pagination: dict = dict(), params: dict = dict()):
+                      pagination: dict = dict(), params: dict = dict(), fields: list = None):
         """
         Check the relationships.
+        The stages depending only on the relations and fields come from a
+        template cached per model class, the query values are bound per call.
 
         :param criteria: Criteria to be used.
         :param key_array: List of keys to be checked.
         :param force_fetch_protected_fields: List of protected fields to be fetched.
         :param pagination: pagination options.
+        :param params: Parameters used for dot notation filters on relations.
+        :param fields: List of fields to be fetched, all of them if None.
         :return: List of checked relations.
         """
-        key_array.sort()
-        the_keys = dict()
-        for k, val in enumerate(key_array):
-            # logging.info(k)
-            key = key_array[k]
-            the_keys[key] = []
-
-        tgt = dict()
-        for i in the_keys:
-            if "." not in i:
-                tgt[i] = []
-            # rever nested fields
-            # else:
-            #    if(!dot.pick(i,tgt,false))
-            #        dot.str(i, the_keys[i], tgt)
-        project = {"$project": {}}
+        joins = self._pipeline_template(key_array, force_fetch_protected_fields)
+        extra_filters = self._relation_filters(params)
+        joined = _relation_tree(key_array)
+
+        window = list()
+        if pagination.get("after"):
+            window.append({"$match": keyset_match(pagination["sort"], pagination["after"])})
+
+        if pagination.get("sort"):
+            window.append({"$sort": pagination["sort"]})
+
+        if pagination.get("page_size") is not None:
+            window.append({"$skip": pagination["page_size"] * pagination.get("page", 0)})
+            window.append({"$limit": pagination["page_size"]})
+
         aggregation = [{"$match": criteria}]
+        # lookups do not change the number of documents, so when only local fields select
+        # and order them the page is cut first and only its documents are joined
+        sorted_by_relation = any(k.split('.')[0] in joined for k in pagination.get("sort") or ())
+        if not extra_filters and not sorted_by_relation:
+            aggregation.extend(window)
+            aggregation.extend(joins)
+        else:
+            aggregation.extend(joins)
+            if extra_filters:
+                aggregation.append({
+                    '$match': extra_filters
+                })
+            aggregation.extend(window)
+
+        if fields:
+            # built per call, field selections would make the templates unbounded
+            project = joins[-1]["$project"]
+            selected = {"_id": True}
+            for f in fields:
+                if project.get(f):
+                    selected[f] = True
+            for i in self.relations:
+                if i in joined:
+                    selected[i] = True
+            aggregation.append({"$project": selected})
+        return aggregation
 
-        for j in self.fields:
-            if j in self.fields:
-                project["$project"][j] = True
-        a = copy.deepcopy(project["$project"])
-        for k in a:
-            if k in self.protected_fields and k not in force_fetch_protected_fields:
-                del project["$project"][k]
+    def _pipeline_template(self, key_array: list, force_fetch_protected_fields: list = list()) -> list:
+        """
+        Returns the stages of a relations aggregation that do not depend on
+        the query: the lookups with the $project shaping their results and
+        dropping protected fields.
+        Templates are cached per model class and shared between calls, so
+        they must not be mutated.
+
+        :param key_array: List of relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :return: List of join stages.
+        """
+        cls = type(self)
+        templates = cls.__dict__.get('_pipeline_templates')
+        if templates is None:
+            templates = cls._pipeline_templates = dict()
+
+        key = (frozenset(key_array), frozenset(force_fetch_protected_fields))
+        template = templates.get(key)
+        if template is None:
+            template = templates[key] = self._build_pipeline_template(key_array, force_fetch_protected_fields)
+        return template
+
+    def _build_pipeline_template(self, key_array: list, force_fetch_protected_fields: list = list()) -> list:
+        project = {
+            j: True for j in self.codec().fields
+            if j not in self.protected_fields or j in force_fetch_protected_fields
+        }
+        joins = list()
+        joined = _relation_tree(key_array)
 
         for i in self.relations:
-            if i in key_array:
-                if self.relations[i]["type"] == Relations.hasManyLocally:
-                    lookup = {
-                        '$lookup': {
-                            "from": self.relations[i]["model"](self.db).collection_name,
-                            'let': {'id_list': '$'+self.relations[i]["localKey"]},
-                            'pipeline': [
-                                {
-                                    '$match': {
-                                        '$expr': {'$in': ['$_id', '$$id_list']}
-                                    }
-                                }
-                            ],
-                            'as': i
-                        }
-                    }
-                    aggregation.append(lookup)
-                else:
-                    lookup = {"$lookup": {
-                        "from": self.relations[i]["model"](self.db).collection_name,
-                        "localField": self.relations[i]["localKey"],
-                        "foreignField": self.relations[i]["foreignKey"],
-                        "as": i
-                    }}
-                    aggregation.append(lookup)
-
-                if self.relations[i]["type"] == Relations.belongsTo:
-                    project["$project"][i] = {"$arrayElemAt": ["$" + i, 0]}
-
-                if self.relations[i]["type"] == Relations.hasOne:
-                    project["$project"][i] = {"$arrayElemAt": ["$" + i, 0]}
-
-                if self.relations[i]["type"] == Relations.belongsToMany:
-                    project["$project"][i] = {"$filter": {
-                        "input": "$" + str(i),
-                        "as": str(i),
-                        "cond": {"$ifNull": ["$$" + str(i) + ".deleted_at", True]}
-                    }}
-
-                if self.relations[i]["type"] == Relations.hasMany:
-                    project["$project"][i] = {"$filter": {
-                        "input": "$" + str(i),
-                        "as": str(i),
-                        "cond": {"$ifNull": ["$$" + str(i) + ".deleted_at", True]}
-                    }}
-
-                if self.relations[i]["type"] == Relations.hasManyLocally:
-                    project["$project"][i] = {"$filter": {
-                        "input": "$" + str(i),
-                        "as": str(i),
-                        "cond": {"$ifNull": ["$$" + str(i) + ".deleted_at", True]}
-                    }}
-
-        aggregation.append(project)
-
-        # Allows dot notation filters to be considered in queries
+            if i in joined:
+                joins.append(self._lookup(i, force_fetch_protected_fields, joined[i]))
+                project[i] = self._joined(i, joined[i])
+
+        joins.append({"$project": project})
+        return joins
+
+    def _lookup_form(self, name: str, nested: list = list()) -> str:
+        """
+        Chooses how a relation is joined, so the related collection is read
+        by index whenever the server allows it:
+        concise, localField/foreignField with a pipeline (concise_lookups, MongoDB 5.0+);
+        eq, a pipeline matching scalar keys by $expr $eq;
+        plain, localField/foreignField without a pipeline, filtered by the $project after it;
+        expr, a pipeline matching keys that may be lists by $expr, which uses no index and is
+        only left for relations with a sort or nested relations on older servers.
+
+        :param name: Relation name.
+        :param nested: Relation paths of the related model to join as well.
+        :return: Name of the form.
+        """
+        relation = self.relations[name]
+        if self.concise_lookups:
+            return 'concise'
+        if relation["type"] != Relations.hasManyLocally and _scalar_key(self, relation["localKey"]) and \
+                _scalar_key(relation["model"], relation["foreignKey"]):
+            return 'eq'
+        if relation.get("sort") or nested:
+            return 'expr'
+        return 'plain'
+
+    def _lookup(self, name: str, force_fetch_protected_fields: list = list(), nested: list = list()) -> dict:
+        """
+        Builds the $lookup of a relation. Sub-pipelines drop soft deleted
+        documents, protected fields and the documents past the relation limit
+        in the related collection instead of joining them first.
+        Relations may declare a `sort` dict and a `limit` for their documents.
+        Nested relation paths are joined inside the sub-pipeline.
+        See _lookup_form for the forms of the stage.
+
+        :param name: Relation name.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param nested: Relation paths of the related model to join as well.
+        :return: $lookup stage.
+        """
+        relation = self.relations[name]
+        model = relation["model"]
+        form = self._lookup_form(name, nested)
+        lookup = {"from": model.collection_name}
+        if relation["type"] == Relations.hasManyLocally:
+            foreign_key = "_id"
+        else:
+            foreign_key = relation["foreignKey"]
+
+        if form == 'plain':
+            # soft deleted documents and the limit are applied by _joined
+            lookup["localField"] = relation["localKey"]
+            lookup["foreignField"] = foreign_key
+            lookup["as"] = name
+            return {"$lookup": lookup}
+
+        match = dict()
+        if form == 'concise':
+            lookup["localField"] = relation["localKey"]
+            lookup["foreignField"] = foreign_key
+        elif form == 'eq':
+            lookup["let"] = {"local_key": "$" + relation["localKey"]}
+            match["$expr"] = {"$eq": ["$" + foreign_key, "$$local_key"]}
+        else:
+            # either side may hold a list of ids, matched by any of them like localField/foreignField
+            lookup["let"] = {"local_key": "$" + relation["localKey"]}
+            match["$expr"] = {"$gt": [
+                {"$size": {"$setIntersection": [_array_expr("$" + foreign_key), _array_expr("$$local_key")]}},
+                0
+            ]}
+        match["deleted_at"] = {"$exists": False}
+
+        pipeline = [{"$match": match}]
+        if relation.get("sort"):
+            pipeline.append({"$sort": relation["sort"]})
+        if relation.get("limit"):
+            pipeline.append({"$limit": relation["limit"]})
+        elif relation["type"] not in MANY_RELATIONS:
+            pipeline.append({"$limit": 1})
+
+        if nested:
+            related = model(self.db)
+            joined = dict()
+            for child, paths in _relation_tree(nested).items():
+                if child not in model.relations:
+                    continue
+                pipeline.append(related._lookup(child, force_fetch_protected_fields, paths))
+                value = related._joined(child, paths)
+                if value is not True:
+                    joined[child] = value
+            if joined:
+                pipeline.append({"$addFields": joined})
+
+        hidden = {p: False for p in model.protected_fields if p not in force_fetch_protected_fields}
+        if hidden:
+            pipeline.append({"$project": hidden})
+
+        lookup["pipeline"] = pipeline
+        lookup["as"] = name
+        return {"$lookup": lookup}
+
+    def _joined(self, name: str, nested: list = list()):
+        """
+        Projection of a joined relation: single relations are unwrapped, and
+        relations joined without a pipeline drop their soft deleted documents
+        and the ones past their limit here.
+
+        :param name: Relation name.
+        :param nested: Relation paths of the related model joined as well.
+        :return: $project value.
+        """
+        relation = self.relations[name]
+        many = relation["type"] in MANY_RELATIONS
+        if self._lookup_form(name, nested) != 'plain':
+            return True if many else {"$arrayElemAt": ["$" + name, 0]}
+
+        value = {"$filter": {
+            "input": "$" + name,
+            "as": "related",
+            "cond": {"$eq": [{"$type": "$$related.deleted_at"}, "missing"]}
+        }}
+        if not many:
+            return {"$arrayElemAt": [value, 0]}
+        if relation.get("limit"):
+            return {"$slice": [value, relation["limit"]]}
+        return value
+
+    async def _aggregate_list(self, pipeline: list, **kwargs) -> list:
+        """
+        Runs an aggregation and collects its documents.
+
+        :param pipeline: Aggregation pipeline.
+        :param kwargs: Options of the aggregate command.
+        :return: List of raw documents.
+        """
+        return [doc async for doc in timed_cursor(self.db[self.collection_name].aggregate(pipeline, **kwargs))]
+
+    def _count_pipeline(self, criteria: dict, params: dict, force_fetch_protected_fields: list = list()) -> list:
+        """
+        Builds the aggregation counting the documents of a paged query.
+        Lookups are only joined for relations filtered by dot notation, since
+        they do not change the number of documents otherwise.
+
+        :param criteria: Criteria to be used.
+        :param params: Parameters used for dot notation filters on relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :return: Count aggregation pipeline.
+        """
+        filtered = [key.split('.')[0] for key in self._relation_filters(params)]
+        if filtered:
+            count_ag = self._relationships(criteria, filtered, force_fetch_protected_fields, params=params)
+        else:
+            count_ag = [{"$match": criteria}]
+        return count_ag + [{"$count": "count"}]
+
+    def _relation_filters(self, params: dict) -> dict:
+        """
+        Allows dot notation filters to be considered in queries.
+
+        :param params: Parameters to be added to the function.
+        :return: Filters on related documents, keyed by dot notation.
+        """
         extra_filters = {}
         for key, value in params.items():
             if '.' in key:
@@ -627,75 +1387,160 @@ class BaseModel:
                     rel_filter = rel_instance.filter({rel_filter_field: value})
                     if rel_filter.get(rel_filter_field):
                         extra_filters[key] = rel_filter.get(rel_filter_field)
-        if extra_filters:
-            aggregation.append({
-                '$match': extra_filters
-            })
-
-        if pagination.get("sort"):
-            aggregation.append({"$sort": pagination["sort"]})
-
-        if pagination != dict():
-            aggregation.append({"$skip": pagination["page_size"] * pagination["page"]})
-            aggregation.append({"$limit": pagination["page_size"]})
-
-        return aggregation
+        return extra_filters
 
+    @instrumented('paged')
     async def paged(self, params: dict, pagination: dict, relations: list,
-                    force_fetch_protected_fields: list = list()) -> dict:
+                    force_fetch_protected_fields: list = list(), fields: list = None, mode: str = None,
+                    after: str = None, strategy: str = None) -> dict:
         """
         Pages a result.
+        Pages are selected by offset, or by keyset when `after` is given:
+        the next page then starts with a range $match on the sort keys, and
+        the result carries the `next` token.
+        In PAGED_FACET mode the page and the total are fetched by a single
+        $facet aggregation, sorted before it unless sorted by a relation;
+        PAGED_CONCURRENT runs two aggregations at the same time instead, for
+        results that may not fit a single 16MB document.
+        Keyset pages always run in PAGED_CONCURRENT mode: $facet sub-pipelines
+        cannot use indexes, so the range $match and $sort must stay outside.
 
         :param params: Parameters to be added to the function.
         :param pagination: Dictionary of pagination.
         :param relations: List of relations.
         :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param fields: List of fields to be fetched, all of them if None.
+        :param mode: PAGED_FACET or PAGED_CONCURRENT, defaults to paged_mode.
+        :param after: Token of the previous page for keyset pagination, '' for the first page.
+        :param strategy: Strategies value used for every relation, overriding their own.
         :return: Paged result.
         """
-        pagination = self.paginate(pagination)
+        if after is not None:
+            pagination = dict(pagination, after=after)
+
+        if self.cache is None:
+            return await self._paged(params, pagination, relations, force_fetch_protected_fields, fields, mode,
+                                     strategy)
+
+        normalized = self.paginate(pagination, params)
+        key = self._cache_key('paged', params, list(normalized.pop("sort").items()), normalized, relations,
+                              force_fetch_protected_fields, fields)
+        paged = self.cache.get(key)
+        if paged is MISS:
+            paged = await self._paged(params, pagination, relations, force_fetch_protected_fields, fields, mode,
+                                      strategy)
+            self.cache.set(key, paged, self._cache_collections(params, relations))
+        return paged
+
+    @instrumented('paged_json')
+    async def paged_json(self, params: dict, pagination: dict, relations: list,
+                         force_fetch_protected_fields: list = list(), fields: list = None, mode: str = None,
+                         after: str = None, strategy: str = None) -> bytes:
+        """
+        Pages a result and returns it as JSON: the result is
+        json.dumps(paged(...), cls=ODMSerializer, separators=(',', ':')),
+        without building the converted documents. The result cache is not used.
+
+        :param params: Parameters to be added to the function.
+        :param pagination: Dictionary of pagination.
+        :param relations: List of relations.
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :param fields: List of fields to be fetched, all of them if None.
+        :param mode: PAGED_FACET or PAGED_CONCURRENT, defaults to paged_mode.
+        :param after: Token of the previous page for keyset pagination, '' for the first page.
+        :param strategy: Strategies value used for every relation, overriding their own.
+        :return: UTF-8 JSON paged result.
+        """
+        if after is not None:
+            pagination = dict(pagination, after=after)
+
+        paged = await self._paged(params, pagination, relations, force_fetch_protected_fields, fields, mode,
+                                  strategy, self._json_encode(force_fetch_protected_fields))
+        results = '[' + ','.join(paged.pop("results")) + ']'
+        return ('{"results":' + results + ',' + dumps_json(paged)[1:]).encode()
+
+    async def _paged(self, params: dict, pagination: dict, relations: list, force_fetch_protected_fields: list,
+                     fields: list, mode: str, strategy: str, convert=None) -> dict:
+        pagination = self.paginate(pagination, params)
         criteria = self.filter(params)
-        ag = self._relationships(criteria, relations, force_fetch_protected_fields, pagination=pagination, params=params)
-
-        if self.debug:
-            print('aggregation', ag)
-
-        cursor = self.db[self.collection_name].aggregate(ag)
-
-        # creates a query search for total itens
-        countAg = self._relationships(criteria, relations, force_fetch_protected_fields, params=params)
-
-        countAg = countAg + [{ '$group': { '_id': None, 'count': { '$sum': 1 } } }, { '$project': { '_id': 0 } }]
-        countCursor = self.db[self.collection_name].aggregate(countAg)
-        count = 0
-        async for doc in countCursor:
-            count = doc['count']
-            
-        results = list()
-        async for doc in cursor:
-            results.append(self.dict_rep(doc))
-
-        for result in results:
-            results = self._clear_protected_fields(
-                self, results, force_fetch_protected_fields)
-
-            for key in self.relations:
-                relation = self.relations[key]["model"](self.db)
-                if result.get(key) is not None:
-                    if type(result[key]) == list:
-                        for k, val in enumerate(result[key]):
-                            result[key][k] = self._clear_protected_fields(
-                                relation, val, force_fetch_protected_fields)
-                    else:
-                        if result.get(key) is not None:
-                            result[key] = self._clear_protected_fields(
-                                relation, result[key], force_fetch_protected_fields)
-        return {
+        lookups, batched = self._relation_strategies(relations, strategy, params, pagination["sort"])
+        local_keys = set()
+        if batched and fields:
+            fields, local_keys = _select_local_keys(self.relations, fields, batched)
+        ag = self._relationships(criteria, lookups, force_fetch_protected_fields, pagination=pagination, params=params,
+                                 fields=fields)
+        sort_keys = set()
+        if pagination.get("keyset"):
+            ag, sort_keys = _project_sort_keys(ag, pagination["sort"])
+        count_ag = self._count_pipeline(criteria, params, force_fetch_protected_fields)
+        kwargs = self._collation_kwargs(params)
+
+        if (mode or self.paged_mode) == self.PAGED_FACET and not pagination.get("keyset"):
+            # both branches share the leading $match, evaluated once by the server
+            head, results = [ag[0]], ag[1:]
+            sort = {"$sort": pagination["sort"]}
+            joined = _relation_tree(lookups)
+            if sort in results and not any(k.split('.')[0] in joined for k in pagination["sort"]):
+                # $facet sub-pipelines cannot use indexes, a sort on local fields runs before it;
+                # lookups and $match keep the order of the documents and the count ignores it
+                results.remove(sort)
+                head.append(sort)
+            ag = head + [{"$facet": {"results": results, "count": count_ag[1:]}}]
+
+            if self.debug:
+                print('aggregation', ag)
+
+            docs, count_docs = list(), list()
+            async for doc in timed_cursor(self.db[self.collection_name].aggregate(ag, **kwargs)):
+                docs = doc["results"]
+                count_docs = doc["count"]
+        else:
+            if self.debug:
+                print('aggregation', ag)
+
+            docs, count_docs = await asyncio.gather(
+                self._aggregate_list(ag, **kwargs),
+                self._aggregate_list(count_ag, **kwargs)
+            )
+
+        next_token = None
+        if pagination.get("keyset") and len(docs) == pagination["page_size"]:
+            next_token = encode_token(sort_values(docs[-1], pagination["sort"]))
+        if sort_keys:
+            # sort keys only fetched for the token, unselected or protected
+            for doc in docs:
+                _drop_keys(doc, sort_keys)
+
+        identity_map = current_session()
+        if identity_map is not None and not lookups and fields is None:
+            hidden = self._hidden_fields(force_fetch_protected_fields)
+            for doc in docs:
+                identity_map.put(self.collection_name, doc, hidden)
+
+        if batched:
+            await self._load_relations(docs, batched, force_fetch_protected_fields)
+            for doc in docs:
+                _drop_keys(doc, local_keys)
+
+        count = count_docs[0]["count"] if count_docs else 0
+        if convert is None:
+            results = [self._convert(doc, force_fetch_protected_fields) for doc in docs]
+        else:
+            results = [convert(doc) for doc in docs]
+
+        paged = {
             "results": results,
             "count": count,
             "page": pagination["page"],
             "page_size": pagination["page_size"]
         }
 
+        if pagination.get("keyset"):
+            paged["next"] = next_token
+
+        return paged
+
+    @instrumented('remove')
     async def remove(self, _id: str, force: bool = False) -> dict:
         """
         Removes a result.
@@ -709,44 +1554,119 @@ class BaseModel:
         removed = False
 
         if self.PRE_DELETE in self.hooks:
-            await self.pre_delete(str(_id))
+            await self._run_hooks(self.PRE_DELETE, [(str(_id),)])
 
         if not self.softDeletes or force:
-            r = await self.db[self.collection_name].delete_one({"_id": ObjectId(_id)})
+            r = await server_call(self.db[self.collection_name].delete_one({"_id": ObjectId(_id)}))
+            invalidate_collection(self.collection_name)
+            if current_session() is not None:
+                current_session().evict(self.collection_name, ObjectId(_id))
             if isinstance(r, DeleteResult):
                 removed = bool(r.deleted_count)
             else:
                 raise Exception('Unexpected query result')
         else:
-            cache_rel = await self.first({"_id": _id}, [])
-            if not cache_rel:
-                raise DocumentNotFound()
-            cache_rel = self.preparse_fields(cache_rel)
-            cache_rel["deleted_at"] = now
-            del cache_rel["_id"]
-            r = await self.db[self.collection_name].update_one({"_id": ObjectId(_id)}, {"$set": cache_rel})
-            if isinstance(r, UpdateResult):
-                removed = bool(r.modified_count)
+            # a single conditional write, the document is only read back for post hooks
+            criteria = {"_id": ObjectId(_id), "deleted_at": {"$exists": False}}
+            update = {"$set": {"deleted_at": now}}
+            if self.POST_DELETE in self.hooks:
+                doc = await server_call(self.db[self.collection_name].find_one_and_update(
+                    criteria, update,
+                    projection=self._projection(),
+                    return_document=ReturnDocument.AFTER
+                ))
+                matched = doc is not None
+                removed = matched
             else:
-                raise Exception('Unexpected query result')
-            saved = copy.deepcopy(cache_rel)
-            saved['_id'] = _id
-            saved = self.dict_rep(saved)
+                r = await server_call(self.db[self.collection_name].update_one(criteria, update))
+                if not isinstance(r, UpdateResult):
+                    raise Exception('Unexpected query result')
+                matched = bool(r.matched_count)
+                removed = bool(r.modified_count)
+            invalidate_collection(self.collection_name)
+            if not matched:
+                raise DocumentNotFound()
+            if current_session() is not None:
+                current_session().update(self.collection_name, ObjectId(_id), {"deleted_at": now})
+            if self.POST_DELETE in self.hooks:
+                saved = self._clear_protected_fields(self, self.dict_rep(doc))
 
         if self.POST_DELETE in self.hooks:
-            await self.post_delete(str(_id), saved, self.softDeletes)
+            await self._run_hooks(self.POST_DELETE, [(str(_id), saved, self.softDeletes)])
+
+        return removed
+
+    @instrumented('remove_many')
+    async def remove_many(self, params: dict, force: bool = False) -> int:
+        """
+        Removes every result of a query with a single write.
+        Soft deletes only set deleted_at; ids are fetched first only when
+        delete hooks are registered.
+
+        :param params: Parameters to be added to the function.
+        :param force: Permanently removes the docs even if soft-delete is enabled.
+        :return: Number of removed documents.
+        """
+        collection = self.db[self.collection_name]
+        criteria = self.filter(params)
+        kwargs = self._collation_kwargs(params)
+        soft = self.softDeletes and not force
+        if soft:
+            criteria["deleted_at"] = {"$exists": False}
+
+        ids = None
+        if self.PRE_DELETE in self.hooks or self.POST_DELETE in self.hooks:
+            ids = [doc["_id"] async for doc in timed_cursor(collection.find(criteria, {"_id": True}, **kwargs))]
+            if not ids:
+                return 0
+            criteria = {"_id": {"$in": ids}}
+            kwargs = dict()
+            if soft:
+                criteria["deleted_at"] = {"$exists": False}
+
+        if ids and self.PRE_DELETE in self.hooks:
+            await self._run_hooks(self.PRE_DELETE, [(str(_id),) for _id in ids], many=True)
+
+        now = datetime.utcnow()
+        if soft:
+            r = await server_call(collection.update_many(criteria, {"$set": {"deleted_at": now}}, **kwargs))
+            removed = r.modified_count
+        else:
+            r = await server_call(collection.delete_many(criteria, **kwargs))
+            removed = r.deleted_count
+        invalidate_collection(self.collection_name)
+
+        identity_map = current_session()
+        if identity_map is not None:
+            if ids is None:
+                identity_map.evict_collection(self.collection_name)
+            for _id in ids or []:
+                if soft:
+                    identity_map.update(self.collection_name, _id, {"deleted_at": now})
+                else:
+                    identity_map.evict(self.collection_name, _id)
+
+        if ids and self.POST_DELETE in self.hooks:
+            await self._run_hooks(self.POST_DELETE, [(str(_id), None, self.softDeletes) for _id in ids], many=True)
 
         return removed
 
     async def _db_update_one(self, where, to_save):
         if self.PRE_UPDATE in self.hooks:
-            await self.pre_update(str(where.get('_id')))
-
-        r = await self.db[self.collection_name].update_one(where, {'$set': to_save})
+            await self._run_hooks(self.PRE_UPDATE, [(str(where.get('_id')),)])
+
+        r = await server_call(self.db[self.collection_name].update_one(where, {'$set': to_save}))
+        invalidate_collection(self.collection_name)
+        identity_map = current_session()
+        if identity_map is not None:
+            if isinstance(where.get('_id'), ObjectId):
+                identity_map.update(self.collection_name, where['_id'], to_save)
+            else:
+                identity_map.evict_collection(self.collection_name)
 
         if self.POST_UPDATE in self.hooks:
             post_doc = self.dict_rep(to_save)
-            await self.post_update(str(post_doc.get('_id')), post_doc)
+            await self._run_hooks(self.POST_UPDATE, [(str(post_doc.get('_id')), post_doc)])
 
         return r
 
@@ -756,30 +1676,37 @@ class BaseModel:
 
         # Pre hooks
         if is_update and self.PRE_UPDATE in self.hooks:
-            await self.pre_update(str(_id))
+            await self._run_hooks(self.PRE_UPDATE, [(str(_id),)])
         elif self.PRE_CREATE in self.hooks:
-            await self.pre_create()
+            await self._run_hooks(self.PRE_CREATE, [()])
 
         # actual persistance
-        _id = await self.db[self.collection_name].save(to_save)
-        post_doc = self.dict_rep(dict(to_save, **{'_id': _id}))
+        _id = await server_call(self.db[self.collection_name].save(to_save))
+        invalidate_collection(self.collection_name)
+        if current_session() is not None:
+            current_session().put(self.collection_name, dict(to_save, _id=_id))
 
         # Post hooks
         if is_update and self.POST_UPDATE in self.hooks:
-            await self.post_update(str(_id), post_doc)
+            post_doc = self.dict_rep(dict(to_save, **{'_id': _id}))
+            await self._run_hooks(self.POST_UPDATE, [(str(_id), post_doc)])
         elif self.POST_CREATE in self.hooks:
-            await self.post_create(str(_id), post_doc)
+            post_doc = self.dict_rep(dict(to_save, **{'_id': _id}))
+            await self._run_hooks(self.POST_CREATE, [(str(_id), post_doc)])
 
         return _id
 
-    async def save(self, bus_object: dict) -> dict:
+    @instrumented('save')
+    async def save(self, bus_object: dict, preparsed: bool = False) -> dict:
         """
         Saves a result.
 
         :param bus_object: Object to be saved.
+        :param preparsed: The values are already converted, like the result of
+            BaseValidator.validate_and_coerce with rules from BaseValidator.from_model.
         :return: Saved dictionary.
         """
-        to_save = self.preparse_fields(bus_object)
+        to_save = self._preparsed(bus_object) if preparsed else self.preparse_fields(bus_object)
         if to_save.get("_id") is None:
             to_save["created_at"] = datetime.utcnow()
             to_save["updated_at"] = datetime.utcnow()
@@ -788,3 +1715,68 @@ class BaseModel:
         _id = await self._db_save(to_save)
         to_save["_id"] = _id
         return self.dict_rep(to_save)
+
+    async def _db_save_many(self, inserts: list, updates: list, ordered: bool, batch_size: int):
+        collection = self.db[self.collection_name]
+
+        # Pre hooks
+        if updates and self.PRE_UPDATE in self.hooks:
+            await self._run_hooks(self.PRE_UPDATE, [(str(doc['_id']),) for doc in updates], many=True)
+        if inserts and self.PRE_CREATE in self.hooks:
+            await self._run_hooks(self.PRE_CREATE, [()] * len(inserts), many=True)
+
+        # actual persistance, insert_many assigns the _id of each document
+        try:
+            for i in range(0, len(inserts), batch_size):
+                await server_call(collection.insert_many(inserts[i:i + batch_size], ordered=ordered))
+            for i in range(0, len(updates), batch_size):
+                requests = [ReplaceOne({'_id': doc['_id']}, doc, upsert=True) for doc in updates[i:i + batch_size]]
+                await server_call(collection.bulk_write(requests, ordered=ordered))
+        finally:
+            invalidate_collection(self.collection_name)
+
+        identity_map = current_session()
+        if identity_map is not None:
+            for doc in inserts + updates:
+                identity_map.put(self.collection_name, doc)
+
+        # Post hooks
+        if updates and self.POST_UPDATE in self.hooks:
+            await self._run_hooks(self.POST_UPDATE, [(str(doc['_id']), self.dict_rep(doc)) for doc in updates],
+                                  many=True)
+        if inserts and self.POST_CREATE in self.hooks:
+            await self._run_hooks(self.POST_CREATE, [(str(doc['_id']), self.dict_rep(doc)) for doc in inserts],
+                                  many=True)
+
+    @instrumented('save_many')
+    async def save_many(self, bus_objects: list, ordered: bool = False, batch_size: int = 1000,
+                        preparsed: bool = False) -> list:
+        """
+        Saves many results with batched writes.
+        New documents are inserted with insert_many and documents with an _id
+        are replaced with bulk_write, batch_size documents per round trip.
+
+        :param bus_objects: Objects to be saved.
+        :param ordered: Stops at the first failed write of a batch when True.
+        :param batch_size: Number of documents per write command.
+        :param preparsed: The values are already converted, see save().
+        :return: Identifiers of the saved objects, in order.
+        """
+        now = datetime.utcnow()
+        to_save = list()
+        inserts = list()
+        updates = list()
+        for bus_object in bus_objects:
+            doc = self._preparsed(bus_object) if preparsed else self.preparse_fields(bus_object)
+            if doc.get("_id") is None:
+                doc["created_at"] = now
+                doc["updated_at"] = now
+                inserts.append(doc)
+            else:
+                doc["updated_at"] = now
+                updates.append(doc)
+            to_save.append(doc)
+
+        await self._db_save_many(inserts, updates, ordered, batch_size)
+
+        return [str(doc["_id"]) for doc in to_save]
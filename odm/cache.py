@@ -0,0 +1,133 @@
+"""
+Cache module.
+Query result cache with LRU/TTL eviction, invalidated by writes.
+"""
+
+import copy
+import json
+import time
+import weakref
+from collections import OrderedDict
+
+from bson import json_util
+
+from .serializers import ODMSerializer
+
+# Returned by QueryCache.get when the key is not cached
+MISS = object()
+
+_caches = weakref.WeakSet()
+
+
+def invalidate_collection(collection_name: str):
+    """
+    Drops the entries of every cache that depend on a collection.
+
+    :param collection_name: Name of the written collection.
+    """
+    for cache in list(_caches):
+        cache.invalidate(collection_name)
+
+
+def make_key(*parts) -> str:
+    """
+    Normalizes query parts into a cache key.
+    Dict keys are sorted, so pass order-sensitive values (like sorts) as lists.
+
+    :param parts: Values identifying a query.
+    :return: Cache key.
+    """
+    return json_util.dumps(parts, sort_keys=True)
+
+
+class QueryCache:
+    """
+    QueryCache class.
+    Bounded by number of entries and, optionally, by the size of the cached
+    results serialized as JSON. Entries expire after ttl seconds.
+
+    :method get(key): Returns a copy of the cached value or MISS.
+    :method set(key, value, collections): Caches a value depending on collections.
+    :method invalidate(collection_name): Drops the entries depending on a collection.
+    :method clear(): Drops every entry.
+    :method stats(): Returns hit/miss statistics.
+    """
+
+    def __init__(self, max_entries: int = 1000, max_bytes: int = None, ttl: float = 60, clock=time.monotonic):
+        """
+        :param max_entries: Maximum number of entries.
+        :param max_bytes: Maximum size of the cached values, unbounded if None.
+        :param ttl: Seconds an entry lives, forever if None.
+        :param clock: Function returning the current time in seconds.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        _caches.add(self)
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return MISS
+
+        value, collections, size, expires_at = entry
+        if expires_at is not None and expires_at <= self.clock():
+            self._drop(key)
+            self.misses += 1
+            return MISS
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return copy.deepcopy(value)
+
+    def set(self, key: str, value, collections):
+        size = 0
+        if self.max_bytes is not None:
+            size = len(json.dumps(value, cls=ODMSerializer))
+            if size > self.max_bytes:
+                return
+
+        if key in self.entries:
+            self._drop(key)
+
+        expires_at = None if self.ttl is None else self.clock() + self.ttl
+        self.entries[key] = (copy.deepcopy(value), frozenset(collections), size, expires_at)
+        self.size += size
+
+        while len(self.entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+            self._drop(next(iter(self.entries)))
+            self.evictions += 1
+
+    def invalidate(self, collection_name: str):
+        keys = [key for key, entry in self.entries.items() if collection_name in entry[1]]
+        for key in keys:
+            self._drop(key)
+        self.invalidations += len(keys)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+    def _drop(self, key: str):
+        entry = self.entries.pop(key)
+        self.size -= entry[2]
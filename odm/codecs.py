@@ -0,0 +1,237 @@
+"""
+Codecs module.
+Per-model field encoders/decoders, compiled once per model class.
+"""
+
+from bson.objectid import ObjectId
+
+from .data_types import Relations, Types
+from .dates import ISO
+
+TIMESTAMP_FIELDS = ("created_at", "updated_at", "deleted_at")
+MANY_RELATIONS = (Relations.hasManyLocally, Relations.hasMany, Relations.belongsToMany)
+
+# Returned by a codec function when the value must not be written to the output
+SKIP = object()
+
+
+def _identity(param, name):
+    return param
+
+
+def _object_id_operators(param, name):
+    result = dict()
+    for k in param:
+        if k == "$in":
+            result["$in"] = [ObjectId(_id) for _id in param["$in"]]
+        elif k == "$ne":
+            result["$ne"] = ObjectId(param["$ne"])
+        else:
+            msg = 'operador não implementado {}'.format(k)
+            raise NotImplementedError(msg)
+    return result
+
+
+# filter(): query values
+
+def _filter_object_id(param, name):
+    if type(param) == str:
+        return ObjectId(param)
+    elif type(param) == dict:
+        return _object_id_operators(param, name)
+    elif type(param) == ObjectId:
+        return param
+    raise NotImplementedError
+
+
+def _filter_object_id_list(param, name):
+    if type(param) == list:
+        return {'$all': [ObjectId(s) for s in param]}
+    elif type(param) == str:
+        tokens = [t.strip() for t in param.split(',')]
+        return {'$all': [ObjectId(s) for s in tokens if s]}
+    elif type(param) == ObjectId:
+        return {'$all': [param]}
+    elif type(param) == dict:
+        return _object_id_operators(param, name)
+    return SKIP
+
+
+def _filter_integer(param, name):
+    if not isinstance(param, int):
+        return int(param)
+    return param
+
+
+def _filter_double(param, name):
+    return float(param)
+
+
+FILTERS = {
+    Types.ObjectId: _filter_object_id,
+    Types.ObjectIdList: _filter_object_id_list,
+    Types.ISODate: ISO.filter,
+    Types.Object: _identity,
+    Types.Array: _identity,
+    Types.Integer: _filter_integer,
+    Types.Double: _filter_double,
+    Types.Boolean: _identity,
+    # Strings are handled by BaseModel.filter, they depend on text_fields
+    Types.String: _identity,
+}
+
+
+# preparse_fields(): python values -> database values
+
+def _encode_object_id(param, name):
+    return ObjectId(param)
+
+
+def _encode_object_id_list(param, name):
+    if type(param) == list:
+        return [ObjectId(s) for s in param]
+    return SKIP
+
+
+def _to_int(param, name):
+    return int(param)
+
+
+def _to_float(param, name):
+    return float(param)
+
+
+def _to_str(param, name):
+    return str(param)
+
+
+ENCODERS = {
+    Types.ObjectId: _encode_object_id,
+    Types.ObjectIdList: _encode_object_id_list,
+    Types.ISODate: ISO.encode,
+    Types.Object: _identity,
+    Types.Array: _identity,
+    Types.Integer: _to_int,
+    Types.Double: _to_float,
+    Types.Boolean: _identity,
+    Types.String: _to_str,
+}
+
+
+# dict_rep(): database values -> representation values
+
+def _decode_object_id(param, name):
+    return str(param)
+
+
+def _decode_object_id_list(param, name):
+    return [str(s) for s in param]
+
+
+DECODERS = {
+    Types.ObjectId: _decode_object_id,
+    Types.ObjectIdList: _decode_object_id_list,
+    Types.ISODate: ISO.decode,
+    Types.Object: _identity,
+    Types.Array: _identity,
+    Types.Integer: _to_int,
+    Types.Double: _to_float,
+    Types.Boolean: _identity,
+    Types.String: _to_str,
+}
+
+
+class ModelCodec:
+    """
+    ModelCodec class.
+    Holds the resolved field functions of a model class.
+
+    :method encode(params): Database representation of params (preparse_fields).
+    :method decode(params): Output representation of a document (dict_rep).
+    """
+
+    def __init__(self, model_cls):
+        fields = dict(model_cls.fields)
+        for name in TIMESTAMP_FIELDS:
+            fields[name] = Types.ISODate
+
+        date_codec = getattr(model_cls, 'date_codec', None) or ISO
+        filters = dict(FILTERS, **{Types.ISODate: date_codec.filter})
+        encoders = dict(ENCODERS, **{Types.ISODate: date_codec.encode})
+        decoders = dict(DECODERS, **{Types.ISODate: date_codec.decode})
+
+        self.model_cls = model_cls
+        self.fields = fields
+        self.filters = {name: filters.get(t) for name, t in fields.items()}
+        self.encoders = [(name, encoders.get(t, _identity)) for name, t in fields.items()]
+        self.decoders = [(name, decoders.get(t, _identity)) for name, t in fields.items()]
+        self._relations = None
+
+    @property
+    def relations(self):
+        """
+        Relations as (name, many, model class), resolved on first use.
+        """
+        if self._relations is None:
+            relations = list()
+            for name, relation in self.model_cls.relations.items():
+                relations.append((name, relation["type"] in MANY_RELATIONS, relation["model"]))
+            self._relations = relations
+        return self._relations
+
+    def encode(self, params: dict) -> dict:
+        query = dict()
+        for name, encoder in self.encoders:
+            param = params.get(name)
+            if param is not None:
+                value = encoder(param, name)
+                if value is not SKIP:
+                    query[name] = value
+        return query
+
+    def decode(self, params: dict, db=None) -> dict:
+        query = dict()
+        for name, decoder in self.decoders:
+            param = params.get(name)
+            if param is not None:
+                query[name] = decoder(param, name)
+
+        for name, many, model_cls in self.relations:
+            param = params.get(name)
+            if param is not None:
+                decode = relation_decoder(model_cls, db)
+                if many:
+                    query[name] = [decode(item) for item in param]
+                else:
+                    query[name] = decode(param)
+
+        return query
+
+
+def get_codec(model_cls) -> ModelCodec:
+    """
+    Returns the codec of a model class, building it on first use.
+
+    :param model_cls: Model class.
+    :return: ModelCodec instance cached on the class.
+    """
+    codec = model_cls.__dict__.get('_codec')
+    if codec is None:
+        codec = ModelCodec(model_cls)
+        model_cls._codec = codec
+    return codec
+
+
+def relation_decoder(model_cls, db=None):
+    """
+    Returns the function used to convert documents of a related model.
+    Models overriding dict_rep keep being instantiated so their override runs.
+
+    :param model_cls: Related model class.
+    :param db: Database handle given to overriding models.
+    :return: Callable receiving a document.
+    """
+    if getattr(model_cls.dict_rep, '_codec_dict_rep', False):
+        codec = get_codec(model_cls)
+        return lambda doc: codec.decode(doc, db)
+    return model_cls(db).dict_rep
@@ -30,3 +30,24 @@ class Relations:
     hasOne = "hasOne"
     belongsToMany = "belongsToMany"
     belongsTo = "belongsTo"
+
+
+class Strategies:
+    """
+    Strategies class.
+    How related documents are loaded.
+
+    """
+    lookup = "lookup"
+    batch = "batch"
+
+
+class SearchModes:
+    """
+    SearchModes class.
+    How a field listed in text_fields is searched.
+
+    """
+    text = "text"
+    prefix = "prefix"
+    substring = "substring"
@@ -0,0 +1,160 @@
+"""
+Dates module.
+Parsing and formatting of ISODate fields.
+"""
+
+import re
+from datetime import datetime, timedelta
+
+from dateutil.parser import parse as date_parser
+
+_ISO_DATE = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d{1,9}))?)?'
+    r'(?:([Zz])|([+-])(\d{2}):?(\d{2})?)?)?$'
+)
+
+FILTER_OPERATORS = ("$gt", "$gte", "$lt", "$lte", "$ne", "$eq")
+
+
+def to_utc(value: datetime) -> datetime:
+    """
+    Converts an aware datetime to a naive UTC datetime, as stored by MongoDB.
+
+    :param value: Datetime.
+    :return: Naive datetime in UTC.
+    """
+    if value.tzinfo is None:
+        return value
+    offset = value.utcoffset()
+    return value.replace(tzinfo=None) - offset if offset else value.replace(tzinfo=None)
+
+
+def parse_iso(value: str):
+    """
+    Parses the common ISO-8601 forms: a date, optionally followed by a time
+    with seconds, fractions and a Z or +HH:MM offset.
+
+    :param value: Date string.
+    :return: Naive datetime in UTC, None if value is not in one of those forms.
+    """
+    match = _ISO_DATE.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zulu, sign, offset_hours, offset_minutes = match.groups()
+    microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    try:
+        parsed = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0),
+                          microsecond)
+    except ValueError:
+        return None
+    if sign:
+        offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes or 0))
+        parsed = parsed - offset if sign == '+' else parsed + offset
+    return parsed
+
+
+class DateCodec:
+    """
+    DateCodec class.
+    Converts the values of ISODate fields; models pick one with `date_codec`.
+
+    :method parse(value): Datetime of a string.
+    :method format(value): String of a datetime.
+    :method filter(param, name): Query value of a filter param.
+    :method encode(param, name): Database value of an input param.
+    :method decode(param, name): Output value of a database value.
+    """
+
+    def __deepcopy__(self, memo):
+        # shared by the models, copied rule sets keep comparing equal to the original ones
+        return self
+
+    def parse(self, value: str) -> datetime:
+        raise NotImplementedError
+
+    def format(self, value: datetime) -> str:
+        raise NotImplementedError
+
+    def filter(self, param, name):
+        if isinstance(param, str):
+            return self.parse(param)
+        if isinstance(param, dict):
+            n_param = dict()
+            for k, v in param.items():
+                if k in FILTER_OPERATORS:
+                    if isinstance(v, str):
+                        n_param[k] = self.parse(v)
+                    elif isinstance(v, datetime):
+                        n_param[k] = v
+                    else:
+                        msg = 'Tipo {} não suportado para o campo {}'.format(type(v), name)
+                        raise Exception(msg)
+            return n_param
+        return param
+
+    def encode(self, param, name):
+        if isinstance(param, str):
+            return self.parse(param)
+        elif isinstance(param, datetime):
+            return param
+        raise Exception('wrong type [{}] for {}'.format(type(param), name))
+
+    def decode(self, param, name):
+        if isinstance(param, str):
+            return self.parse(param)
+        return self.format(param)
+
+
+class IsoDateCodec(DateCodec):
+    """
+    IsoDateCodec class.
+    Parses ISO-8601 strings without dateutil, which is only used for other
+    formats. Every parsed or formatted date is in UTC.
+    """
+
+    def parse(self, value: str) -> datetime:
+        parsed = parse_iso(value)
+        if parsed is None:
+            parsed = to_utc(date_parser(value))
+        return parsed
+
+    def format(self, value: datetime) -> str:
+        if value.tzinfo is not None:
+            value = to_utc(value)
+        return value.isoformat() + 'Z'
+
+    def decode(self, param, name):
+        # inlined format(), called for every date of every read document
+        if isinstance(param, str):
+            return self.parse(param)
+        if param.tzinfo is not None:
+            param = to_utc(param)
+        return param.isoformat() + 'Z'
+
+
+class DateutilDateCodec(DateCodec):
+    """
+    DateutilDateCodec class.
+    Parses every string with dateutil, keeping their timezones.
+    """
+
+    def parse(self, value: str) -> datetime:
+        return date_parser(value)
+
+    def format(self, value: datetime) -> str:
+        return value.isoformat() + 'Z'
+
+
+ISO = IsoDateCodec()
+DATEUTIL = DateutilDateCodec()
+
+
+def format_date(value: datetime) -> str:
+    """
+    Formats a datetime as an ISO-8601 string in UTC.
+
+    :param value: Datetime.
+    :return: Date string ending in Z.
+    """
+    return ISO.format(value)
@@ -1,2 +1,6 @@
 class DocumentNotFound(Exception):
-    pass
\ No newline at end of file
+    pass
+
+
+class InvalidPaginationToken(Exception):
+    pass
@@ -0,0 +1,88 @@
+"""
+Hooks module.
+Runs deferred model hooks outside of the write path.
+"""
+
+import asyncio
+import contextvars
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HookDispatcher:
+    """
+    HookDispatcher class.
+    Deferred hook calls go to a bounded queue consumed by worker tasks.
+    Events of the same model class and hook found together in the queue are
+    handed to the model's *_many hook as one batch, up to batch_size events.
+
+    :method dispatch(model, hook, args): Queues a hook call.
+    :method drain(): Waits for the queued calls and stops the workers.
+    """
+
+    def __init__(self, maxsize: int = 1000, concurrency: int = 1, batch_size: int = 1):
+        """
+        :param maxsize: Queue size, dispatch waits for room when it is full.
+        :param concurrency: Number of worker tasks.
+        :param batch_size: Maximum number of events handed to a hook at once.
+        """
+        self.maxsize = maxsize
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.queue = None
+        self.workers = list()
+        self.processed = 0
+        self.failed = 0
+
+    async def dispatch(self, model, hook: str, args: tuple):
+        """
+        Queues a hook call, waiting while the queue is full.
+
+        :param model: Model instance the hook belongs to.
+        :param hook: Hook name, like BaseModel.POST_CREATE.
+        :param args: Arguments of the hook.
+        """
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.maxsize)
+        if not self.workers:
+            # started in an empty context, so they do not keep the session and the
+            # instrumentation event of the request that happened to dispatch first
+            loop = asyncio.get_event_loop()
+            self.workers = [contextvars.Context().run(loop.create_task, self._work())
+                            for _ in range(self.concurrency)]
+        await self.queue.put((model, hook, args))
+
+    async def drain(self):
+        """
+        Waits for every queued hook call to finish and stops the workers.
+        """
+        if self.queue is not None:
+            await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        if self.workers:
+            await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = list()
+
+    async def _work(self):
+        while True:
+            events = [await self.queue.get()]
+            while len(events) < self.batch_size and not self.queue.empty():
+                events.append(self.queue.get_nowait())
+
+            groups = dict()
+            for model, hook, args in events:
+                group = groups.setdefault((type(model), hook), (model, list()))
+                group[1].append(args)
+
+            for (_, hook), (model, args_list) in groups.items():
+                try:
+                    await model._call_hooks(hook, args_list, many=True)
+                    self.processed += len(args_list)
+                except Exception:
+                    self.failed += len(args_list)
+                    logger.exception('deferred hook %s of %s failed', hook, type(model).__name__)
+
+            for _ in events:
+                self.queue.task_done()
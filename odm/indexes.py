@@ -0,0 +1,84 @@
+"""
+Indexes module.
+Declared and derived indexes of models.
+"""
+
+from pymongo import ASCENDING, TEXT, IndexModel
+
+from .data_types import Relations, SearchModes
+
+
+def index_model(spec) -> IndexModel:
+    """
+    Normalizes an index declaration.
+
+    :param spec: IndexModel, field name, list of (field, direction) or dict
+        with `keys` plus IndexModel options (unique, partialFilterExpression, ...).
+    :return: IndexModel instance.
+    """
+    if isinstance(spec, IndexModel):
+        return spec
+    if isinstance(spec, dict):
+        options = dict(spec)
+        keys = options.pop('keys')
+        return IndexModel(_keys(keys), **options)
+    return IndexModel(_keys(spec))
+
+
+def index_keys(model: IndexModel) -> tuple:
+    """
+    Returns the key specification of an index, used to compare indexes.
+
+    :param model: IndexModel instance.
+    :return: Tuple of (field, direction).
+    """
+    return tuple(model.document['key'].items())
+
+
+def _keys(keys) -> list:
+    if isinstance(keys, str):
+        return [(keys, ASCENDING)]
+    return [(k, ASCENDING) if isinstance(k, str) else tuple(k) for k in keys]
+
+
+def recommended_indexes(model_cls) -> dict:
+    """
+    Derives the indexes the queries of a model rely on:
+    the foreign keys joined by its relations, the local id arrays of
+    hasManyLocally relations, the soft delete predicate added by filter(),
+    the default sorts, the text index of SearchModes.text fields and the
+    search_collation indexes of SearchModes.prefix fields.
+
+    :param model_cls: Model class.
+    :return: Dict of collection name to list of IndexModel.
+    """
+    indexes = dict()
+
+    def add(collection_name, keys, **kwargs):
+        if collection_name and keys != [("_id", ASCENDING)]:
+            indexes.setdefault(collection_name, []).append(IndexModel(keys, **kwargs))
+
+    for relation in model_cls.relations.values():
+        related = relation["model"]
+        if relation["type"] == Relations.hasManyLocally:
+            add(model_cls.collection_name, [(relation["localKey"], ASCENDING)])
+        else:
+            add(related.collection_name, [(relation["foreignKey"], ASCENDING)])
+
+    text_fields = [name for name, mode in model_cls.search_modes.items() if mode == SearchModes.text]
+    if text_fields:
+        add(model_cls.collection_name, [(name, TEXT) for name in text_fields])
+
+    if model_cls.search_collation:
+        for name, mode in model_cls.search_modes.items():
+            if mode == SearchModes.prefix:
+                add(model_cls.collection_name, [(name, ASCENDING)], collation=model_cls.search_collation)
+
+    if model_cls.softDeletes:
+        # {deleted_at: {$exists: false}} is an equality on null for the index
+        add(model_cls.collection_name, [("deleted_at", ASCENDING), ("_id", ASCENDING)])
+        add(model_cls.collection_name, [("deleted_at", ASCENDING), ("created_at", ASCENDING)])
+    else:
+        add(model_cls.collection_name, [("created_at", ASCENDING)])
+
+    return indexes
@@ -0,0 +1,266 @@
+"""
+Instrumentation module.
+Per-operation events, slow query log and metrics adapters.
+"""
+
+import functools
+import logging
+import time
+from contextvars import ContextVar
+
+logger = logging.getLogger(__name__)
+
+_current = ContextVar('odm_operation', default=None)
+
+
+def current_event():
+    """
+    Returns the event of the instrumented operation being run.
+
+    :return: OperationEvent instance, None outside of instrumented operations.
+    """
+    return _current.get()
+
+
+def query_shape(query):
+    """
+    Normalizes a query by replacing its values with '?', keeping field names
+    and operators, so queries differing only by values share a shape.
+
+    :param query: Query parameters.
+    :return: Query shape.
+    """
+    if isinstance(query, dict):
+        return {k: query_shape(v) for k, v in sorted(query.items(), key=lambda item: str(item[0]))}
+    if isinstance(query, (list, tuple)) and query and isinstance(query[0], dict):
+        return [query_shape(v) for v in query]
+    return '?'
+
+
+class OperationEvent:
+    """
+    OperationEvent class.
+    Measures of one BaseModel operation. Times are in seconds; server_time is
+    spent waiting on the database, conversion_time in dict_rep and protected
+    field cleaning, hook_time in hooks run inline.
+    """
+
+    def __init__(self, collection: str, operation: str, shape=None):
+        self.collection = collection
+        self.operation = operation
+        self.shape = shape
+        self.round_trips = 0
+        self.documents = 0
+        self.server_time = 0.0
+        self.conversion_time = 0.0
+        self.hook_time = 0.0
+        self.started_at = time.perf_counter()
+        self.duration = None
+        self.error = None
+
+    def as_dict(self) -> dict:
+        return {
+            "collection": self.collection,
+            "operation": self.operation,
+            "shape": self.shape,
+            "round_trips": self.round_trips,
+            "documents": self.documents,
+            "duration": self.duration,
+            "server_time": self.server_time,
+            "conversion_time": self.conversion_time,
+            "hook_time": self.hook_time,
+            "error": repr(self.error) if self.error is not None else None,
+        }
+
+
+class Instrumentation:
+    """
+    Instrumentation class.
+    Base listener of BaseModel.instrumentation.
+
+    :method start(event): Called before the operation runs.
+    :method end(event): Called after the operation, successful or not.
+    """
+
+    def start(self, event: OperationEvent):
+        pass
+
+    def end(self, event: OperationEvent):
+        pass
+
+
+class SlowQueryLogger(Instrumentation):
+    """
+    SlowQueryLogger class.
+    Logs the operations taking at least threshold seconds.
+    """
+
+    def __init__(self, threshold: float = 0.5, log: logging.Logger = None, level: int = logging.WARNING):
+        self.threshold = threshold
+        self.log = log or logging.getLogger('odm.slow_query')
+        self.level = level
+
+    def end(self, event: OperationEvent):
+        if event.duration >= self.threshold:
+            self.log.log(
+                self.level,
+                'slow %s on %s: %.1fms (server %.1fms, conversion %.1fms, hooks %.1fms), '
+                '%d round trips, %d documents, shape %s',
+                event.operation, event.collection, event.duration * 1000, event.server_time * 1000,
+                event.conversion_time * 1000, event.hook_time * 1000, event.round_trips, event.documents,
+                event.shape
+            )
+
+
+class MetricsCallback(Instrumentation):
+    """
+    MetricsCallback class.
+    Reports every event as metrics through record(name, value, labels).
+    Labels are collection, operation and status.
+    """
+
+    METRICS = (
+        ('odm_operation_seconds', 'duration'),
+        ('odm_server_seconds', 'server_time'),
+        ('odm_conversion_seconds', 'conversion_time'),
+        ('odm_hook_seconds', 'hook_time'),
+        ('odm_round_trips', 'round_trips'),
+        ('odm_documents', 'documents'),
+    )
+
+    def __init__(self, record):
+        """
+        :param record: Callable receiving (metric name, value, labels dict).
+        """
+        self.record = record
+
+    def end(self, event: OperationEvent):
+        labels = {
+            "collection": event.collection,
+            "operation": event.operation,
+            "status": "error" if event.error is not None else "ok",
+        }
+        for name, attribute in self.METRICS:
+            self.record(name, getattr(event, attribute), labels)
+
+    @classmethod
+    def prometheus(cls, histograms: dict):
+        """
+        Adapter for prometheus_client histograms created with the
+        labelnames collection, operation and status.
+
+        :param histograms: Dict of metric name to Histogram, missing metrics are skipped.
+        :return: MetricsCallback instance.
+        """
+        def record(name, value, labels):
+            if name in histograms:
+                histograms[name].labels(**labels).observe(value)
+        return cls(record)
+
+    @classmethod
+    def opentelemetry(cls, instruments: dict):
+        """
+        Adapter for OpenTelemetry histograms.
+
+        :param instruments: Dict of metric name to Histogram, missing metrics are skipped.
+        :return: MetricsCallback instance.
+        """
+        def record(name, value, labels):
+            if name in instruments:
+                instruments[name].record(value, attributes=labels)
+        return cls(record)
+
+
+def _returned(result) -> int:
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict):
+        return len(result["results"]) if isinstance(result.get("results"), list) else 1
+    return 0
+
+
+def _notify(listeners, method: str, event: OperationEvent):
+    for listener in listeners:
+        try:
+            getattr(listener, method)(event)
+        except Exception:
+            logger.exception('instrumentation %s failed', type(listener).__name__)
+
+
+def instrumented(operation: str):
+    """
+    Decorates a BaseModel coroutine so its calls emit OperationEvents to
+    the listeners of the model's instrumentation list.
+
+    :param operation: Operation name reported in the events.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            if not self.instrumentation:
+                return await fn(self, *args, **kwargs)
+
+            query = args[0] if args else None
+            shape = query_shape(query) if isinstance(query, dict) else None
+            if operation == 'remove':
+                shape = {'_id': '?'}
+            event = OperationEvent(self.collection_name, operation, shape)
+            token = _current.set(event)
+            _notify(self.instrumentation, 'start', event)
+            try:
+                result = await fn(self, *args, **kwargs)
+                event.documents = _returned(result)
+                return result
+            except Exception as e:
+                event.error = e
+                raise
+            finally:
+                event.duration = time.perf_counter() - event.started_at
+                _current.reset(token)
+                _notify(self.instrumentation, 'end', event)
+        return wrapper
+    return decorator
+
+
+async def server_call(awaitable):
+    """
+    Awaits a database command, accounting it to the current event.
+
+    :param awaitable: Database command.
+    :return: Command result.
+    """
+    event = _current.get()
+    if event is None:
+        return await awaitable
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        event.server_time += time.perf_counter() - start
+        event.round_trips += 1
+
+
+async def timed_cursor(cursor):
+    """
+    Iterates over a cursor, accounting the waits to the current event.
+
+    :param cursor: Motor cursor.
+    :return: Async iterator of documents.
+    """
+    event = _current.get()
+    if event is None:
+        async for doc in cursor:
+            yield doc
+        return
+
+    event.round_trips += 1
+    iterator = cursor.__aiter__()
+    while True:
+        start = time.perf_counter()
+        try:
+            doc = await iterator.__anext__()
+        except StopAsyncIteration:
+            break
+        finally:
+            event.server_time += time.perf_counter() - start
+        yield doc
@@ -0,0 +1,221 @@
+"""
+JSON encoder module.
+Writes database documents straight to JSON, compiled once per model class.
+"""
+
+from datetime import datetime
+from json.encoder import c_make_encoder, encode_basestring_ascii
+from math import isfinite
+
+from bson.objectid import ObjectId
+
+from .codecs import get_codec
+from .data_types import Types
+from .dates import ISO, IsoDateCodec
+from .serializers import ODMSerializer
+
+_serializer = ODMSerializer(separators=(',', ':'))
+if c_make_encoder is not None:
+    # built once instead of on every encode() call, documents have no cycles to check
+    _c_encoder = c_make_encoder(None, _serializer.default, encode_basestring_ascii, None, ':', ',', False, False,
+                                True)
+else:
+    _c_encoder = None
+
+
+def dumps_json(value) -> str:
+    """
+    Writes a value as compact JSON, with ObjectIds and dates as strings.
+    Used for Object and Array fields and values of unexpected types.
+
+    :param value: Value.
+    :return: JSON text.
+    """
+    if _c_encoder is None:
+        return _serializer.encode(value)
+    return ''.join(_c_encoder(value, 0))
+
+
+def _string(value) -> str:
+    return encode_basestring_ascii(str(value))
+
+
+def _object_id(value) -> str:
+    if type(value) is ObjectId:
+        return '"' + value.binary.hex() + '"'
+    return _string(value)
+
+
+def _object_id_list(value) -> str:
+    return '[' + ','.join([_object_id(v) for v in value]) + ']'
+
+
+def _integer(value) -> str:
+    return int.__repr__(int(value))
+
+
+def _double(value) -> str:
+    value = float(value)
+    if isfinite(value):
+        return float.__repr__(value)
+    if value != value:
+        return 'NaN'
+    return 'Infinity' if value > 0 else '-Infinity'
+
+
+def _date(date_codec, name):
+    def encode(value):
+        value = date_codec.decode(value, name)
+        return _string(value) if isinstance(value, str) else dumps_json(value)
+    return encode
+
+
+# expressions writing the value v of a field, the common types are inlined
+EXPRESSIONS = {
+    Types.ObjectId: '(\'"\' + v.binary.hex() + \'"\' if type(v) is _ObjectId else _object_id(v))',
+    Types.ObjectIdList: '_object_id_list(v)',
+    Types.Integer: '(_int_repr(v) if type(v) is int else _integer(v))',
+    Types.Double: '(_float_repr(v) if type(v) is float and _isfinite(v) else _double(v))',
+    Types.Boolean: "('true' if v is True else 'false' if v is False else dumps_json(v))",
+    Types.String: '(_escape(v) if type(v) is str else _string(v))',
+}
+
+
+class _Plan:
+    """
+    Encoding of a model for one list of force_fetch_protected_fields.
+    encode(doc) is generated once the relations are resolved.
+    """
+
+    encode = None
+
+
+class ModelJsonEncoder:
+    """
+    ModelJsonEncoder class.
+    Writes the output representation of documents (dict_rep without the
+    protected fields) as JSON text, without building it first.
+
+    :method plan(force_fetch_protected_fields): Encoder of documents, None if dict_rep is overridden.
+    """
+
+    def __init__(self, model_cls):
+        self.model_cls = model_cls
+        self.codec = get_codec(model_cls)
+        self.date_codec = getattr(model_cls, 'date_codec', None) or ISO
+        self._plans = dict()
+
+    def plan(self, force_fetch_protected_fields: list = list()):
+        """
+        Returns the encoder of documents fetched with a list of protected fields.
+        Models overriding dict_rep, this one or a related one, have no plan:
+        their documents must go through dict_rep.
+
+        :param force_fetch_protected_fields: List of protected fields to be fetched.
+        :return: _Plan instance, None if dict_rep must be used.
+        """
+        key = frozenset(force_fetch_protected_fields)
+        if key in self._plans:
+            return self._plans[key]
+
+        if not _uses_codec(self.model_cls, set()):
+            self._plans[key] = None
+            return None
+
+        # stored before the relations are resolved, so models related to themselves end
+        plan = self._plans[key] = _Plan()
+        hidden = {p for p in self.model_cls.protected_fields if p not in key}
+        relations = [(name, many, get_json_encoder(related).plan(force_fetch_protected_fields))
+                     for name, many, related in self.codec.relations]
+        plan.encode = self._compile(hidden, relations)
+        return plan
+
+    def _compile(self, hidden: set, relations: list):
+        namespace = {
+            '_ObjectId': ObjectId,
+            '_datetime': datetime,
+            '_object_id': _object_id,
+            '_object_id_list': _object_id_list,
+            '_int_repr': int.__repr__,
+            '_integer': _integer,
+            '_float_repr': float.__repr__,
+            '_isfinite': isfinite,
+            '_double': _double,
+            '_escape': encode_basestring_ascii,
+            '_string': _string,
+            'dumps_json': dumps_json,
+        }
+        lines = ['def encode(d):', '    p = []', '    a = p.append']
+        positions = {name: i for i, (name, many, plan) in enumerate(relations)}
+
+        def field(name, field_type, i):
+            if field_type == Types.ISODate:
+                namespace['_date%d' % i] = _date(self.date_codec, name)
+                if type(self.date_codec) is IsoDateCodec:
+                    return '(\'"\' + v.isoformat() + \'Z"\' if type(v) is _datetime and v.tzinfo is None ' \
+                           'else _date%d(v))' % i
+                return '_date%d(v)' % i
+            return EXPRESSIONS.get(field_type, 'dumps_json(v)')
+
+        def relation(i):
+            name, many, plan = relations[i]
+            namespace['_plan%d' % i] = plan
+            key = encode_basestring_ascii(name) + ':'
+            # a local key sharing the name of its relation is written as a field when it was not loaded
+            fallback = field(name, self.codec.fields.get(name), len(self.codec.fields) + i)
+            lines.append('    v = d.get(%r)' % name)
+            lines.append('    if v is not None:')
+            if many:
+                lines.append('        if type(v) is list and all(type(r) is dict for r in v):')
+                lines.append("            a(%r + '[' + ','.join([_plan%d.encode(r) for r in v]) + ']')" % (key, i))
+            else:
+                lines.append('        if type(v) is dict:')
+                lines.append('            a(%r + _plan%d.encode(v))' % (key, i))
+            lines.append('        else:')
+            lines.append('            a(%r + %s)' % (key, fallback))
+
+        # dict_rep writes the fields first, a relation sharing the name of a field takes its position
+        for i, (name, field_type) in enumerate(self.codec.fields.items()):
+            if name in hidden:
+                continue
+            if name in positions:
+                relation(positions[name])
+                continue
+            lines.append('    v = d.get(%r)' % name)
+            lines.append('    if v is not None:')
+            lines.append('        a(%r + %s)' % (encode_basestring_ascii(name) + ':', field(name, field_type, i)))
+
+        for i, (name, many, plan) in enumerate(relations):
+            if name not in self.codec.fields:
+                relation(i)
+        lines.append("    return '{' + ','.join(p) + '}'")
+
+        source = '\n'.join(lines)
+        exec(compile(source, '<json encoder %s>' % self.model_cls.__name__, 'exec'), namespace)
+        encode = namespace['encode']
+        encode.source = source
+        return encode
+
+
+def _uses_codec(model_cls, seen: set) -> bool:
+    # True when neither the model nor the models it relates to override dict_rep
+    if model_cls in seen:
+        return True
+    seen.add(model_cls)
+    if not getattr(model_cls.dict_rep, '_codec_dict_rep', False):
+        return False
+    return all(_uses_codec(related, seen) for name, many, related in get_codec(model_cls).relations)
+
+
+def get_json_encoder(model_cls) -> ModelJsonEncoder:
+    """
+    Returns the JSON encoder of a model class, building it on first use.
+
+    :param model_cls: Model class.
+    :return: ModelJsonEncoder instance cached on the class.
+    """
+    encoder = model_cls.__dict__.get('_json_encoder')
+    if encoder is None:
+        encoder = ModelJsonEncoder(model_cls)
+        model_cls._json_encoder = encoder
+    return encoder
@@ -0,0 +1,101 @@
+"""
+Keyset module.
+Helpers for cursor based (seek) pagination.
+"""
+
+import base64
+import binascii
+
+from bson import json_util
+
+from .exceptions import InvalidPaginationToken
+
+
+def keyset_sort(sort: dict) -> dict:
+    """
+    Makes a sort total by appending _id as the last key.
+
+    :param sort: Sort query as returned by BaseModel.sort_query.
+    :return: Sort query ending with _id.
+    """
+    sort = dict(sort)
+    if "_id" not in sort:
+        directions = list(sort.values())
+        sort["_id"] = directions[-1] if directions else 1
+    return sort
+
+
+def sort_values(doc: dict, sort: dict) -> list:
+    """
+    Reads the values of the sort keys from a raw document.
+
+    :param doc: Raw document.
+    :param sort: Sort query.
+    :return: List of values in sort order.
+    """
+    values = list()
+    for key in sort:
+        value = doc
+        for part in key.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        values.append(value)
+    return values
+
+
+def encode_token(values: list) -> str:
+    """
+    Encodes the sort values of the last document of a page.
+
+    :param values: Values in sort order.
+    :return: Opaque token.
+    """
+    raw = json_util.dumps(values).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_token(token: str, size: int = None) -> list:
+    """
+    Decodes a token created by encode_token.
+
+    :param token: Opaque token.
+    :param size: Expected number of values, the number of sort keys.
+    :return: Values in sort order.
+    """
+    try:
+        values = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise InvalidPaginationToken(str(e))
+    if not isinstance(values, list):
+        raise InvalidPaginationToken('token inválido')
+    if size is not None and len(values) != size:
+        raise InvalidPaginationToken('token não corresponde à ordenação')
+    return values
+
+
+def keyset_match(sort: dict, values: list) -> dict:
+    """
+    Builds the range query selecting the documents after the given values.
+    Null and missing values sort before any other, and range operators
+    never match them, so they are selected by equality instead.
+
+    :param sort: Sort query ending with _id.
+    :param values: Values in sort order.
+    :return: $match query.
+    """
+    keys = list(sort.items())
+    conditions = list()
+    for i, (key, direction) in enumerate(keys):
+        prefix = {keys[j][0]: values[j] for j in range(i)}
+        ascending = int(direction) > 0
+        if values[i] is None:
+            # every value comes after null in ascending order, none in descending order
+            if ascending:
+                conditions.append(dict(prefix, **{key: {"$ne": None}}))
+            continue
+        conditions.append(dict(prefix, **{key: {"$gt" if ascending else "$lt": values[i]}}))
+        if not ascending and key != "_id":
+            conditions.append(dict(prefix, **{key: None}))
+
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$or": conditions}
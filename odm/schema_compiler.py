@@ -0,0 +1,195 @@
+"""
+Schema compiler module.
+Generates Python validation functions from JSON schemas.
+"""
+
+import numbers
+import re
+
+# keywords checked by jsonschema that the generated code does not support
+UNSUPPORTED = frozenset([
+    '$ref', 'allOf', 'anyOf', 'oneOf', 'not', 'patternProperties', 'dependencies', 'additionalItems',
+    'uniqueItems', 'multipleOf', 'minProperties', 'maxProperties',
+])
+
+# draft 4 type checks of jsonschema, also deciding which keywords apply to a value
+BUILTIN_TYPES = {
+    'object': 'isinstance({v}, dict)',
+    'array': 'isinstance({v}, list)',
+    'string': 'isinstance({v}, str)',
+    'integer': '(isinstance({v}, int) and not isinstance({v}, bool))',
+    'number': '(isinstance({v}, _Number) and not isinstance({v}, bool))',
+    'boolean': 'isinstance({v}, bool)',
+    'null': '{v} is None',
+}
+
+
+def _enum_member(instance, enum) -> bool:
+    # stricter than jsonschema (1 and 1.0 or True differ), a miss only costs a full validation
+    return any(type(e) is type(instance) and e == instance for e in enum)
+
+
+class _Compiler:
+
+    def __init__(self, types: dict):
+        self.types = types
+        self.lines = list()
+        self.constants = list()
+        self.variables = 0
+
+    def constant(self, value) -> str:
+        self.constants.append(value)
+        return '_c[%d]' % (len(self.constants) - 1)
+
+    def variable(self) -> str:
+        self.variables += 1
+        return 'v%d' % self.variables
+
+    def emit(self, depth: int, line: str):
+        self.lines.append('    ' * depth + line)
+
+    def is_type(self, name: str, var: str) -> str:
+        if name in self.types:
+            return 'isinstance(%s, %s)' % (var, self.constant(self.types[name]))
+        if name in BUILTIN_TYPES:
+            return BUILTIN_TYPES[name].format(v=var)
+        raise _Unsupported(name)
+
+    def schema(self, schema: dict, var: str, depth: int):
+        if not isinstance(schema, dict):
+            raise _Unsupported(schema)
+        for keyword in schema:
+            if keyword in UNSUPPORTED:
+                raise _Unsupported(keyword)
+
+        if 'type' in schema:
+            names = schema['type'] if isinstance(schema['type'], list) else [schema['type']]
+            if not all(isinstance(name, str) for name in names):
+                raise _Unsupported('type')
+            self.emit(depth, 'if not (%s): return False' % ' or '.join(self.is_type(n, var) for n in names))
+
+        if 'enum' in schema:
+            self.emit(depth, 'if not _enum_member(%s, %s): return False' % (var, self.constant(schema['enum'])))
+
+        if 'method' in schema:
+            self.emit(depth, 'try:')
+            self.emit(depth + 1, '%s(%s, validator=_validator)' % (self.constant(schema['method']), var))
+            self.emit(depth, 'except Exception:')
+            self.emit(depth + 1, 'return False')
+
+        self.string(schema, var, depth)
+        self.number(schema, var, depth)
+        self.object(schema, var, depth)
+        self.array(schema, var, depth)
+
+    def string(self, schema: dict, var: str, depth: int):
+        checks = list()
+        if 'minLength' in schema:
+            checks.append('len(%s) < %d' % (var, schema['minLength']))
+        if 'maxLength' in schema:
+            checks.append('len(%s) > %d' % (var, schema['maxLength']))
+        if 'pattern' in schema:
+            checks.append('not %s.search(%s)' % (self.constant(re.compile(schema['pattern'])), var))
+        if checks:
+            self.emit(depth, 'if %s and (%s): return False' % (self.is_type('string', var), ' or '.join(checks)))
+
+    def number(self, schema: dict, var: str, depth: int):
+        checks = list()
+        if 'minimum' in schema:
+            operator = '<=' if schema.get('exclusiveMinimum') else '<'
+            checks.append('%s %s %s' % (var, operator, self.constant(schema['minimum'])))
+        if 'maximum' in schema:
+            operator = '>=' if schema.get('exclusiveMaximum') else '>'
+            checks.append('%s %s %s' % (var, operator, self.constant(schema['maximum'])))
+        if checks:
+            self.emit(depth, 'if %s and (%s): return False' % (self.is_type('number', var), ' or '.join(checks)))
+
+    def object(self, schema: dict, var: str, depth: int):
+        properties = schema.get('properties', {})
+        additional = schema.get('additionalProperties', True)
+        required = schema.get('required', [])
+        if not (properties or required or additional is not True):
+            return
+
+        self.emit(depth, 'if %s:' % self.is_type('object', var))
+        depth += 1
+        for name in required:
+            self.emit(depth, 'if %r not in %s: return False' % (name, var))
+        for name, subschema in properties.items():
+            item = self.variable()
+            self.emit(depth, '%s = %s.get(%r, _MISSING)' % (item, var, name))
+            self.emit(depth, 'if %s is not _MISSING:' % item)
+            mark = len(self.lines)
+            self.schema(subschema, item, depth + 1)
+            if len(self.lines) == mark:
+                self.emit(depth + 1, 'pass')
+        if additional is False:
+            self.emit(depth, 'if not %s.issuperset(%s): return False' % (self.constant(frozenset(properties)), var))
+        elif isinstance(additional, dict):
+            key = self.variable()
+            self.emit(depth, 'for %s in %s:' % (key, var))
+            self.emit(depth + 1, 'if %s in %s: continue' % (key, self.constant(frozenset(properties))))
+            item = self.variable()
+            self.emit(depth + 1, '%s = %s[%s]' % (item, var, key))
+            self.schema(additional, item, depth + 1)
+
+    def array(self, schema: dict, var: str, depth: int):
+        checks = list()
+        if 'minItems' in schema:
+            checks.append('len(%s) < %d' % (var, schema['minItems']))
+        if 'maxItems' in schema:
+            checks.append('len(%s) > %d' % (var, schema['maxItems']))
+        if checks:
+            self.emit(depth, 'if %s and (%s): return False' % (self.is_type('array', var), ' or '.join(checks)))
+
+        items = schema.get('items')
+        if items is None:
+            return
+        if not isinstance(items, dict):
+            raise _Unsupported('items')
+        item = self.variable()
+        self.emit(depth, 'if %s:' % self.is_type('array', var))
+        self.emit(depth + 1, 'for %s in %s:' % (item, var))
+        mark = len(self.lines)
+        self.schema(items, item, depth + 2)
+        if len(self.lines) == mark:
+            self.emit(depth + 2, 'pass')
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def compile_schema(schema: dict, types: dict = None, validator=None):
+    """
+    Generates a function telling whether an instance is valid against a
+    draft 4 schema, with the custom `method` keyword and custom types like
+    object_id. It only answers True or False: errors are described by
+    running the jsonschema validator, so invalid instances are never
+    reported with different messages.
+
+    :param schema: JSON schema.
+    :param types: Dict of type name to class or tuple of classes.
+    :param validator: jsonschema validator given to `method` functions.
+    :return: Function receiving an instance, None if the schema uses a keyword
+        the generated code does not support.
+    """
+    compiler = _Compiler(types or {})
+    compiler.emit(0, 'def compiled(v0):')
+    try:
+        compiler.schema(schema, 'v0', 1)
+    except _Unsupported:
+        return None
+    compiler.emit(1, 'return True')
+
+    namespace = {
+        '_c': compiler.constants,
+        '_validator': validator,
+        '_enum_member': _enum_member,
+        '_Number': numbers.Number,
+        '_MISSING': object(),
+    }
+    exec(compile('\n'.join(compiler.lines), '<compiled schema>', 'exec'), namespace)
+    compiled = namespace['compiled']
+    compiled.source = '\n'.join(compiler.lines)
+    return compiled
@@ -3,13 +3,15 @@ from datetime import datetime
 
 from bson import ObjectId, Timestamp
 
+from .dates import format_date
+
 
 class ODMSerializer(json.JSONEncoder):
     def default(self, o):
         if isinstance(o, Timestamp):
-            return o.as_datetime().isoformat() + 'Z'
+            return format_date(o.as_datetime())
         if isinstance(o, ObjectId):
             return str(o)
         if isinstance(o, datetime):
-            return o.isoformat() + 'Z'
+            return format_date(o)
         return json.JSONEncoder.default(self, o)
@@ -0,0 +1,96 @@
+"""
+Session module.
+Request scoped identity map of documents loaded by _id.
+"""
+
+from contextvars import ContextVar
+
+_current = ContextVar('odm_session', default=None)
+
+
+def current_session():
+    """
+    Returns the identity map of the active session.
+
+    :return: IdentityMap instance, None outside of a session.
+    """
+    return _current.get()
+
+
+class IdentityMap:
+    """
+    IdentityMap class.
+    Raw documents keyed by (collection, _id). Each entry records the fields
+    left out by the projection it was fetched with, so it only serves reads
+    that would leave out at least the same fields.
+
+    :method get(collection_name, _id, hidden): Returns a stored document or None.
+    :method put(collection_name, doc, hidden): Stores a document.
+    :method update(collection_name, _id, changes): Applies a $set to a stored document.
+    :method evict(collection_name, _id): Forgets a document.
+    :method evict_collection(collection_name): Forgets every document of a collection.
+    """
+
+    def __init__(self):
+        self.documents = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, collection_name: str, _id, hidden=frozenset()):
+        entry = self.documents.get((collection_name, _id))
+        if entry is None or not entry[1] <= set(hidden):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[0]
+
+    def put(self, collection_name: str, doc: dict, hidden=frozenset()):
+        if doc.get('_id') is not None:
+            self.documents[(collection_name, doc['_id'])] = (dict(doc), frozenset(hidden))
+
+    def update(self, collection_name: str, _id, changes: dict):
+        entry = self.documents.get((collection_name, _id))
+        if entry is not None:
+            self.documents[(collection_name, _id)] = (dict(entry[0], **changes), entry[1])
+
+    def evict(self, collection_name: str, _id):
+        self.documents.pop((collection_name, _id), None)
+
+    def evict_collection(self, collection_name: str):
+        for key in [key for key in self.documents if key[0] == collection_name]:
+            del self.documents[key]
+
+
+class Session:
+    """
+    Session class.
+    Unit of work scope: reads by _id made inside `async with session():` are
+    served from an identity map, kept up to date by the writes of the scope.
+    """
+
+    def __init__(self):
+        self.identity_map = IdentityMap()
+        self._token = None
+
+    def __enter__(self) -> IdentityMap:
+        self._token = _current.set(self.identity_map)
+        return self.identity_map
+
+    def __exit__(self, *exc):
+        _current.reset(self._token)
+        self._token = None
+
+    async def __aenter__(self) -> IdentityMap:
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+
+def session() -> Session:
+    """
+    Opens a unit of work scope, used as `async with odm.session(): ...`.
+
+    :return: Session instance.
+    """
+    return Session()
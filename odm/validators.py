@@ -3,49 +3,122 @@ BaseValidator module.
 It serves as an base to all other validators childs.
 """
 
+import asyncio
+import copy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 import jsonschema
 from jsonschema import Draft4Validator
+from jsonschema.validators import extend
 from bson.objectid import ObjectId
 
+from .codecs import ENCODERS, SKIP
+from .data_types import Types
+from .dates import ISO, IsoDateCodec
+from .schema_compiler import compile_schema
+
 _types = {
     'object_id': ObjectId
 }
 
 
 class ValidationError(Exception):
-    def __init__(self, *args, errors: list=None, messages: list=None, **kwargs):
+    def __init__(self, *args, errors: list=None, messages: list=None, paths: list=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.messages = messages
         self.errors = errors
+        self.paths = paths
+
+
+def _method(validator, fn, instance, schema):
+    try:
+        fn(instance, validator=validator)
+    except Exception as e:
+        yield jsonschema.ValidationError("%r failed for %r: %r" % (instance, fn.__name__, e))
+
+
+# Draft4Validator with the `method` keyword, leaving the VALIDATORS of Draft4Validator untouched
+MethodValidator = extend(Draft4Validator, {'method': _method})
+
+_NOT_COMPILED = object()
+_cache = OrderedDict()
+CACHE_SIZE = 256
+
+
+def _freeze(value):
+    # hashable form of a schema, callables (like `method` functions) by identity
+    if isinstance(value, dict):
+        return ('dict', tuple(sorted((str(k), _freeze(v)) for k, v in value.items())))
+    if isinstance(value, (list, tuple)):
+        return ('list', tuple(_freeze(v) for v in value))
+    try:
+        hash(value)
+    except TypeError:
+        return ('id', id(value))
+    return (type(value).__name__, value)
+
+
+def get_validator(schema: dict, types: dict = None, compiled: bool = False):
+    """
+    Returns the validator of a schema from a process-wide cache keyed by the
+    schema contents and the types.
+
+    :param schema: JSON schema.
+    :param types: Dict of type name to class or tuple of classes.
+    :param compiled: Also returns the generated validation function.
+    :return: jsonschema validator, or tuple with the validator and the generated
+        function (None when the schema cannot be compiled) if compiled is True.
+    """
+    types = _types if types is None else types
+    key = (_freeze(schema), _freeze(types))
+    entry = _cache.get(key)
+    if entry is None:
+        # schemas are kept in the entry so ids of frozen callables stay unique
+        entry = [MethodValidator(schema, types=types), _NOT_COMPILED, schema, types]
+        _cache[key] = entry
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+
+    if not compiled:
+        return entry[0]
+    if entry[1] is _NOT_COMPILED:
+        entry[1] = compile_schema(schema, types, entry[0])
+    return entry[0], entry[1]
 
 
 class JsonSchemaValidator():
     TYPES = _types
     SCHEMA = dict()
     VALIDATOR = None
+    COMPILED = None
+    _executor = None  # (workers, ProcessPoolExecutor) of validate_many
 
-    def __init__(self, schema: dict, additional_types: dict=None, **kwargs):
+    def __init__(self, schema: dict, additional_types: dict=None, compiled: bool=False, **kwargs):
         """
         Arguments:
             schema {dict} -- valida jsonschema
         Keyword Arguments:
             additional_types {dict} -- additional types to be checked against (default: {None})
+            compiled {bool} -- checks valid instances with a generated function first (default: {False})
         """
 
         self.SCHEMA = schema
+        self.compiled = compiled
         if additional_types:
             self.TYPES = dict(self.TYPES, **additional_types)
-        self.VALIDATOR = Draft4Validator(self.SCHEMA, types=self.TYPES)
-        self.VALIDATOR.VALIDATORS['method'] = self.__method
-
-    def __method(self, validator, fn, instance, schema):
-        try:
-            fn(instance, validator=validator)
-        except Exception as e:
-            yield ValidationError("%r failed for %r: %r" % (instance, fn.__name__, e))
+        if compiled:
+            self.VALIDATOR, self.COMPILED = get_validator(self.SCHEMA, self.TYPES, compiled=True)
+        else:
+            self.VALIDATOR = get_validator(self.SCHEMA, self.TYPES)
 
     def validate(self, instance):
+        # the generated function only tells valid instances apart, errors come from jsonschema
+        if self.COMPILED is not None and self.COMPILED(instance):
+            return True
+
         messages = list()
         errors = list()
         for e in self.VALIDATOR.iter_errors(instance):
@@ -53,20 +126,215 @@ class JsonSchemaValidator():
             messages.append(e.schema.get('description', e.message))
         if len(errors):
             msg = '\n'.join(messages)
-            raise ValidationError(msg, messages=messages, errors=errors)
+            raise ValidationError(msg, messages=messages, errors=errors, paths=[list(e.path) for e in errors])
         return True
 
+    def validate_many(self, instances, workers: int=None, chunk_size: int=1000) -> dict:
+        """
+        Validates many instances, spreading chunks of them over a process
+        pool. The schema is sent once to each worker process, so it must be
+        picklable (method functions defined at module level) unless processes
+        are forked. The pool is kept by the validator for the next calls
+        until close() is called.
+
+        Arguments:
+            instances {list} -- instances to be validated
+        Keyword Arguments:
+            workers {int} -- number of processes, validates in this process if 0 (default: {cpu count})
+            chunk_size {int} -- number of instances sent to a worker at once (default: {1000})
+        Returns:
+            dict -- ValidationError (messages and paths) by index of the invalid instances
+        """
+        instances = list(instances)
+        if workers == 0 or len(instances) <= chunk_size:
+            return self._collect([_validate_chunk(0, instances, self)])
+
+        starts = range(0, len(instances), chunk_size)
+        chunks = [instances[start:start + chunk_size] for start in starts]
+        return self._collect(self._pool(workers).map(_validate_chunk, starts, chunks))
+
+    async def validate_many_async(self, instances, workers: int=None, chunk_size: int=1000) -> dict:
+        """
+        Same as validate_many, awaiting the process pool so the event loop
+        keeps serving other tasks. Batches validated in this process run in
+        the default executor of the loop.
+        """
+        loop = asyncio.get_event_loop()
+        instances = list(instances)
+        if workers == 0 or len(instances) <= chunk_size:
+            return self._collect([await loop.run_in_executor(None, _validate_chunk, 0, instances, self)])
+
+        pool = self._pool(workers)
+        results = await asyncio.gather(*[
+            loop.run_in_executor(pool, _validate_chunk, start, instances[start:start + chunk_size])
+            for start in range(0, len(instances), chunk_size)
+        ])
+        return self._collect(results)
+
+    def _pool(self, workers: int=None) -> ProcessPoolExecutor:
+        # reused while the number of workers is the same, the workers already hold the validator
+        if self._executor is not None and self._executor[0] == workers:
+            return self._executor[1]
+        self.close(wait=False)
+        pool = ProcessPoolExecutor(max_workers=workers or None, initializer=_init_worker,
+                                   initargs=(self.SCHEMA, self.TYPES, self.compiled))
+        self._executor = (workers, pool)
+        return pool
+
+    def close(self, wait: bool=True):
+        """
+        Shuts down the process pool of validate_many.
+
+        Keyword Arguments:
+            wait {bool} -- waits for the worker processes to exit (default: {True})
+        """
+        if self._executor is not None:
+            self._executor[1].shutdown(wait=wait)
+            self._executor = None
+
+    def _collect(self, results) -> dict:
+        errors = dict()
+        for chunk in results:
+            for index, messages, paths in chunk:
+                errors[index] = ValidationError('\n'.join(messages), messages=messages, paths=paths)
+        return errors
+
+
+def _plain(coerce):
+    def check(validator, field, rule, name):
+        return coerce(field, rule)
+    return check
+
+
+def _overridden(method: str, coerce):
+    # a subclass check decides validity, the value is converted when the default parser allows
+    def check(validator, field, rule, name):
+        if not getattr(validator, method)(field, rule):
+            raise ValueError(field)
+        try:
+            return coerce(validator, field, rule, name)
+        except Exception:
+            return field
+    return check
+
+
+def _typed(coerce, encoder):
+    def check(validator, field, rule, name):
+        return encoder(coerce(validator, field, rule, name), name)
+    return check
+
+
+# validator of a worker process of JsonSchemaValidator.validate_many
+_worker_validator = None
+
+
+def _init_worker(schema: dict, types: dict, compiled: bool):
+    global _worker_validator
+    _worker_validator = JsonSchemaValidator(schema, additional_types=types, compiled=compiled)
+
+
+def _validate_chunk(start: int, instances: list, validator: JsonSchemaValidator=None) -> list:
+    validator = validator or _worker_validator
+    invalid = list()
+    for i, instance in enumerate(instances):
+        try:
+            validator.validate(instance)
+        except ValidationError as e:
+            invalid.append((start + i, e.messages, e.paths))
+    return invalid
+
 def validate_once(instance, schema, additional_types: dict=None, **kwargs):
     validator = JsonSchemaValidator(schema, additional_types=additional_types, **kwargs)
     validator.validate(instance)
     return True
 
 
+# rule format of each field type, used by BaseValidator.from_model
+FORMATS = {
+    Types.String: "string",
+    Types.ISODate: "datetime",
+    Types.Integer: "integer",
+    Types.Double: "float",
+    Types.Object: "object",
+    Types.Array: "array",
+    Types.ObjectId: "objectid",
+    Types.ObjectIdList: "array",
+    Types.Boolean: "boolean",
+}
+
+# rule format => (check method, error message)
+FORMAT_CHECKS = {
+    "datetime": ("validate_datetime", "A data '{0}' esta em um formato inválido: {1}"),
+    "integer": ("validate_integer", "O inteiro '{0}' esta em um formato inválido: {1}"),
+    "float": ("validate_float", "O decimal '{0}' esta em um formato inválido: {1}"),
+    "string": ("validate_str", "A string '{0}' esta em um formato inválido"),
+    "array": ("validate_array", "O array '{0}' esta em um formato inválido"),
+    "objectid": ("validate_objectid", "O ObjectId '{0}' esta em um formato inválido: {1}"),
+    "object": ("validate_object", "O Object '{0}' esta em um formato inválido"),
+    "boolean": ("validate_boolean", "O Boolean '{0}' esta em um formato inválido"),
+}
+
+
+def _coerce_datetime(field, rule):
+    if isinstance(field, datetime):
+        return field
+    parsed = datetime.strptime(field[:19], "%Y-%m-%dT%H:%M:%S")
+    codec = rule.get("codec", ISO)
+    if len(field) == 19 and type(codec) is IsoDateCodec:
+        return parsed
+    # fractions and offsets, parsed like preparse_fields does
+    return codec.parse(field)
+
+
+def _coerce_str(field, rule):
+    value = str(field)
+    if rule.get("min") and len(value) < rule["min"]:
+        raise ValueError(field)
+    if rule.get("max") and len(value) > rule["max"]:
+        raise ValueError(field)
+    return value
+
+
+def _coerce_array(field, rule):
+    value = list(field)
+    if rule.get("min") and len(value) < rule["min"]:
+        raise ValueError(field)
+    if rule.get("max") and len(value) > rule["max"]:
+        raise ValueError(field)
+    return field
+
+
+def _coerce_object(field, rule):
+    dict(field)
+    return field
+
+
+def _coerce_boolean(field, rule):
+    if type(field) != bool:
+        raise ValueError(field)
+    return field
+
+
+# rule format => function returning the parsed value or raising for invalid values
+COERCERS = {
+    "datetime": _coerce_datetime,
+    "integer": lambda field, rule: int(field),
+    "float": lambda field, rule: float(field),
+    "string": _coerce_str,
+    "array": _coerce_array,
+    "objectid": lambda field, rule: ObjectId(field),
+    "object": _coerce_object,
+    "boolean": _coerce_boolean,
+}
+
+
 class BaseValidator:
     """
     BaseValidator class.
 
+    :method from_model(model, required, missing, presence): Rule set of the fields of a model.
     :method validate(ruleSet, methods): Validation main function.
+    :method validate_and_coerce(rule_set, methods): Validates and converts the params in one pass.
     :method validate_datetime(field, rule): Validates if a field is a datatime.
     :method validate_integer(field, rule): Validates if a field is an integer.
     :method validate_float(field, rule): Validates if a field is a float.
@@ -90,20 +358,59 @@ class BaseValidator:
 
         }
 
-    def validate(self, rule_set, methods=[]):
+    @classmethod
+    def from_model(cls, model, required: list = (), missing: list = (), presence: str = OPTIONAL) -> dict:
         """
-        Validation main function.
+        Rule set of the fields of a model. Rules carry the field type and
+        the date codec, so validate_and_coerce converts values like
+        preparse_fields does. Fields of other types have no rule.
+
+        :param model: Model class.
+        :param required: Fields with REQUIRED presence.
+        :param missing: Fields with MISSING presence.
+        :param presence: Presence of the other fields.
+        :return: Rule set.
+        """
+        rules = dict()
+        date_codec = getattr(model, 'date_codec', None) or ISO
+        for name, field_type in model.fields.items():
+            if field_type not in FORMATS:
+                continue
+            if name in required:
+                field_presence = cls.REQUIRED
+            elif name in missing:
+                field_presence = cls.MISSING
+            else:
+                field_presence = presence
+            rules[name] = {"presence": field_presence, "format": FORMATS[field_type], "type": field_type}
+            if field_type == Types.ISODate:
+                rules[name]["codec"] = date_codec
+        return rules
+
+    def _compiled_rules(self, rule_set: str) -> list:
+        """
+        Checks a rule set once and resolves the function of each rule.
+        Compiled rule sets are cached per validator class and reused while
+        the rules of the instance are equal to the compiled ones.
 
         :param rule_set: Sets of rules to be validated.
-        :param methods: Methods to be called.
-        :return: Return is there was any error.
+        :return: List of (field, presence, coerce, message, rule).
         """
-        valid = True
-        if self.rules.get(rule_set) is None:
+        rules = self.rules.get(rule_set)
+        if rules is None:
             raise Exception("O Conjunto de regras " +
                             rule_set + " não esta definido.")
 
-        for k, rule in self.rules[rule_set].items():
+        cls = type(self)
+        cache = cls.__dict__.get('_rule_sets')
+        if cache is None:
+            cache = cls._rule_sets = dict()
+        cached = cache.get(rule_set)
+        if cached is not None and (cached[0] is rules or cached[0] == rules):
+            return cached[1]
+
+        compiled = list()
+        for k, rule in rules.items():
             if rule.get("presence") is None:
                 raise Exception(
                     "A propriedade presence é obrigatória na regra " + k)
@@ -112,61 +419,71 @@ class BaseValidator:
                 raise Exception(
                     "A propriedade format é obrigatória na regra " + k)
 
-            if rule["presence"] == self.REQUIRED and self.params.get(k) is None:
+            coerce, message = None, None
+            if rule["format"] in FORMAT_CHECKS:
+                method, message = FORMAT_CHECKS[rule["format"]]
+                coerce = _plain(COERCERS[rule["format"]])
+                if getattr(cls, method) is not getattr(BaseValidator, method):
+                    coerce = _overridden(method, coerce)
+                # the parsers already return the type of the field when the format matches it
+                field_type = rule.get("type")
+                if field_type is not None and (FORMATS.get(field_type) != rule["format"] or
+                                               field_type == Types.ObjectIdList):
+                    coerce = _typed(coerce, ENCODERS[field_type])
+            compiled.append((k, rule["presence"], coerce, message, rule))
+
+        cache[rule_set] = (copy.deepcopy(rules), compiled)
+        return compiled
+
+    def validate(self, rule_set, methods=[]):
+        """
+        Validation main function.
+
+        :param rule_set: Sets of rules to be validated.
+        :param methods: Methods to be called.
+        :return: Return is there was any error.
+        """
+        return self.validate_and_coerce(rule_set, methods) is not None
+
+    def validate_and_coerce(self, rule_set, methods=[]):
+        """
+        Validates the params and converts the values of the ruled fields in
+        the same pass, so they are parsed once.
+
+        :param rule_set: Sets of rules to be validated.
+        :param methods: Methods to be called.
+        :return: Params with converted values, None if there was any error.
+        """
+        coerced = dict(self.params)
+        for k, presence, coerce, message, rule in self._compiled_rules(rule_set):
+            value = self.params.get(k)
+            if presence == self.REQUIRED and value is None:
                 self.errors.append("Atributo '" + k +
                                    "' é requerido e não está presente")
 
-            elif rule["presence"] == self.MISSING and self.params.get(k) is not None:
+            elif presence == self.MISSING and value is not None:
                 self.errors.append("Atributo '" + k +
                                    "' não pode estar preenchido")
 
-            elif self.params.get(k) is not None:
-                if "datetime" == rule["format"]:
-                    if not self.validate_datetime(self.params[k], rule):
-                        self.errors.append(
-                            "A data '" + k + "' esta em um formato inválido: " + self.params[k])
-
-                if "integer" == rule["format"]:
-                    if not self.validate_integer(self.params[k], rule):
-                        self.errors.append(
-                            "O inteiro '" + k + "' esta em um formato inválido: " + self.params[k])
-
-                if "float" == rule["format"]:
-                    if not self.validate_float(self.params[k], rule):
-                        self.errors.append(
-                            "O decimal '" + k + "' esta em um formato inválido: " + self.params[k])
-
-                if "string" == rule["format"]:
-                    if not self.validate_str(self.params[k], rule):
-                        self.errors.append(
-                            "A string '" + k + "' esta em um formato inválido")
-
-                if "array" == rule["format"]:
-                    if not self.validate_array(self.params[k], rule):
-                        self.errors.append(
-                            "O array '" + k + "' esta em um formato inválido")
-
-                if "objectid" == rule["format"]:
-                    if not self.validate_objectid(self.params[k], rule):
-                        self.errors.append(
-                            "O ObjectId '" + k + "' esta em um formato inválido: " + self.params[k])
-
-                if "object" == rule["format"]:
-                    if not self.validate_object(self.params[k], rule):
-                        self.errors.append(
-                            "O Object '" + k + "' esta em um formato inválido")
-
-                if "boolean" == rule["format"]:
-                    if not self.validate_boolean(self.params[k], rule):
-                        self.errors.append(
-                            "O Boolean '" + k + "' esta em um formato inválido")
+            elif value is not None and coerce is not None:
+                try:
+                    value = coerce(self, value, rule, k)
+                except Exception:
+                    self.errors.append(message.format(k, value))
+                    continue
+                if value is SKIP:
+                    del coerced[k]
+                else:
+                    coerced[k] = value
 
         for method in methods:
             m = getattr(self, method)
             if m is not None:
                 m()
 
-        return len(self.errors) == 0
+        if len(self.errors):
+            return None
+        return coerced
 
     def validate_datetime(self, field: str, rule: dict = {}):
         """
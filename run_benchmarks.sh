@@ -0,0 +1,2 @@
+#!/bin/sh
+python benchmarks/bench_odm.py "$@"
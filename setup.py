@@ -8,8 +8,8 @@ setup(
     description='Engine MongoDB',
     author='Grupo New Way',
     author_email='contato@gruponewway.com.br',
-    python_requires='>=3.6',
-    classifiers=['Programming Language :: Python :: 3.6'],
+    python_requires='>=3.7',
+    classifiers=['Programming Language :: Python :: 3.7'],
     packages=find_packages(),
     url='https://git.newwaycorp.io/libraries/python/mongo-odm',
     install_requires=[
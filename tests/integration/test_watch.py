@@ -0,0 +1,60 @@
+"""
+Change stream tests against a real single-node replica set, e.g.:
+
+    mongod --replSet rs0 --dbpath /tmp/rs0 && mongo --eval 'rs.initiate()'
+    MONGO_REPLICA_SET_URI=mongodb://localhost:27017/?replicaSet=rs0 python -m pytest tests/integration
+"""
+import asyncio
+import os
+
+import pytest
+
+from odm import BaseModel
+from odm.data_types import Types
+
+URI = os.environ.get('MONGO_REPLICA_SET_URI')
+
+pytestmark = pytest.mark.skipif(not URI, reason='MONGO_REPLICA_SET_URI is not set')
+
+
+class Note(BaseModel):
+    collection_name = 'odm_watch_notes'
+    softDeletes = True
+    fields = {
+        '_id': Types.ObjectId,
+        'title': Types.String,
+        'token': Types.String,
+    }
+    protected_fields = ['token']
+
+
+def test_watch_replica_set():
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    loop = asyncio.get_event_loop()
+    db = AsyncIOMotorClient(URI, io_loop=loop)['odm_tests']
+    model = Note(db)
+
+    async def scenario():
+        await db[Note.collection_name].delete_many({})
+        events = list()
+
+        async def consume():
+            async for event in model.watch({'title': 'watched'}):
+                events.append(event)
+                if len(events) == 2:
+                    return
+
+        consumer = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.5)
+        saved = await model.save({'title': 'watched', 'token': 'secret'})
+        await model.save({'title': 'ignored'})
+        await model.remove(saved['_id'])
+        await asyncio.wait_for(consumer, 10)
+        return saved, events
+
+    saved, events = loop.run_until_complete(scenario())
+    assert [e['operation'] for e in events] == ['insert', 'delete']
+    assert events[0]['document']['title'] == 'watched'
+    assert 'token' not in events[0]['document']
+    assert events[1]['_id'] == saved['_id']
@@ -1,9 +1,128 @@
 import asyncio
+import json
 import logging
+from datetime import datetime
 
 import pytest
+from bson.objectid import ObjectId
+from jsonschema import Draft4Validator
+from pymongo import IndexModel
+from pymongo.results import UpdateResult
 
+import odm
 from odm import BaseModel
+from odm.cache import MISS, QueryCache
+from odm.data_types import Relations, SearchModes, Strategies, Types
+from odm.dates import DATEUTIL, ISO, parse_iso
+from odm.exceptions import DocumentNotFound, InvalidPaginationToken
+from odm.hooks import HookDispatcher
+from odm.indexes import index_keys
+from odm.instrumentation import Instrumentation, MetricsCallback, SlowQueryLogger
+from odm.keyset import decode_token, encode_token, keyset_match
+from odm.serializers import ODMSerializer
+from odm.validators import BaseValidator, JsonSchemaValidator, ValidationError
+
+
+class City(BaseModel):
+    collection_name = 'cities'
+    fields = {
+        '_id': Types.ObjectId,
+        'name': Types.String,
+        'secret': Types.String,
+    }
+    protected_fields = ['secret']
+
+
+class User(BaseModel):
+    collection_name = 'users'
+    fields = {
+        '_id': Types.ObjectId,
+        'name': Types.String,
+        'age': Types.Integer,
+        'city_id': Types.ObjectId,
+        'tags': Types.ObjectIdList,
+        'password': Types.String,
+    }
+    protected_fields = ['password']
+    relations = {
+        'city': {
+            'type': Relations.belongsTo,
+            'model': City,
+            'localKey': 'city_id',
+            'foreignKey': '_id',
+        }
+    }
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = list(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.docs:
+            raise StopAsyncIteration
+        return self.docs.pop(0)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakeCollection:
+    """Records the calls it receives and answers with canned documents."""
+
+    def __init__(self, docs=(), responses=()):
+        self.docs = list(docs)
+        self.responses = list(responses)
+        self.calls = []
+        self.matched = 1
+
+    def find(self, *args, **kwargs):
+        self.calls.append(('find', args, kwargs))
+        return FakeCursor(self.docs)
+
+    def aggregate(self, pipeline, **kwargs):
+        self.calls.append(('aggregate', (pipeline,), kwargs))
+        if self.responses:
+            return FakeCursor(self.responses.pop(0))
+        return FakeCursor(self.docs)
+
+    def watch(self, pipeline, **kwargs):
+        self.calls.append(('watch', (pipeline,), kwargs))
+        return FakeCursor(self.docs)
+
+    async def insert_many(self, docs, **kwargs):
+        self.calls.append(('insert_many', (docs,), kwargs))
+        for doc in docs:
+            doc.setdefault('_id', ObjectId())
+
+    async def bulk_write(self, requests, **kwargs):
+        self.calls.append(('bulk_write', (requests,), kwargs))
+
+    async def update_one(self, *args, **kwargs):
+        self.calls.append(('update_one', args, kwargs))
+        return UpdateResult({'n': self.matched, 'nModified': self.matched}, True)
+
+    async def update_many(self, *args, **kwargs):
+        self.calls.append(('update_many', args, kwargs))
+        return UpdateResult({'n': self.matched, 'nModified': self.matched}, True)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        self.calls.append(('find_one_and_update', args, kwargs))
+        return self.docs[0] if self.docs else None
+
+    async def create_indexes(self, models, **kwargs):
+        self.calls.append(('create_indexes', (models,), kwargs))
+        return [m.document['name'] for m in models]
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
 
 
 def test_split():
@@ -26,5 +145,942 @@ def test_split():
         assert output == model._split(*args, **kwargs)
 
 
+def test_codec_is_cached_per_class():
+    assert User.codec() is User.codec()
+    assert City.codec() is not User.codec()
+    assert 'created_at' in User.codec().fields
+    assert 'created_at' not in User.fields
+    assert BaseModel.codec().fields == {
+        'created_at': Types.ISODate,
+        'updated_at': Types.ISODate,
+        'deleted_at': Types.ISODate,
+    }
+
+
+def test_dict_rep_and_preparse_fields():
+    _id = ObjectId()
+    model = User(None)
+    doc = {
+        '_id': _id,
+        'name': 'john',
+        'age': '30',
+        'unknown': 1,
+        'city': {'_id': _id, 'name': 'Recife'},
+        'created_at': datetime(2020, 1, 1),
+    }
+
+    rep = model.dict_rep(doc)
+    assert rep == {
+        '_id': str(_id),
+        'name': 'john',
+        'age': 30,
+        'created_at': '2020-01-01T00:00:00Z',
+        'city': {'_id': str(_id), 'name': 'Recife'},
+    }
+
+    parsed = model.preparse_fields({'_id': str(_id), 'tags': [str(_id)], 'age': '1'})
+    assert parsed == {'_id': _id, 'tags': [_id], 'age': 1}
+
+
+def test_filter():
+    _id = ObjectId()
+    model = User(None)
+    query = model.filter({
+        '_id': str(_id),
+        'age': '3',
+        'name': 'jo',
+        'tags': '{0}, {0}'.format(_id),
+        'city_id': {'$in': [str(_id)]},
+        'text_fields': 'name',
+        'page': 1,
+    })
+    assert query == {
+        '_id': _id,
+        'age': 3,
+        'name': {'$gte': 'jo', '$lt': 'jo\uffff'},
+        'tags': {'$all': [_id, _id]},
+        'city_id': {'$in': [_id]},
+        'deleted_at': {'$exists': False},
+    }
+
+
+def test_stream():
+    _id = ObjectId()
+    users = FakeCollection([
+        {'_id': _id, 'name': 'a', 'password': 'x'},
+        {'_id': _id, 'name': 'b', 'password': 'y'},
+    ])
+    model = User({'users': users})
+
+    async def collect(**kwargs):
+        return [doc async for doc in model.stream({}, **kwargs)]
+
+    assert run(collect(batch_size=10)) == [
+        {'_id': str(_id), 'name': 'a'},
+        {'_id': str(_id), 'name': 'b'},
+    ]
+    assert users.calls[0][0] == 'find'
+    assert users.calls[0][2]['batch_size'] == 10
+
+    users.docs = [{'_id': _id, 'password': 'x', 'city': {'_id': _id, 'secret': 's'}}]
+    docs = run(collect(relations=['city'], force_fetch_protected_fields=['password']))
+    assert docs == [{'_id': str(_id), 'password': 'x', 'city': {'_id': str(_id)}}]
+    assert users.calls[1][0] == 'aggregate'
+
+
+def test_projection():
+    model = User(None)
+    assert model._projection() == {'password': False}
+    assert model._projection(force_fetch_protected_fields=['password']) is None
+    assert model._projection(['name', 'password']) == {'name': True}
+    assert BaseModel(None)._projection() is None
+
+    ag = model._relationships({}, ['city'], fields=['name', 'password'])
+    assert ag[1]['$lookup']['pipeline'][-1] == {'$project': {'secret': False}}
+    assert ag[-1] == {'$project': {'_id': True, 'name': True, 'city': True}}
+
+    users = FakeCollection()
+    model = User({'users': users})
+    run(model.first({}, fields=['name']))
+    assert users.calls[0][1][1] == {'name': True}
+
+
+def test_pipeline_templates():
+    class Templated(User):
+        pass
+
+    model = Templated({})
+    relations = ['city']
+    first = model._relationships({'name': 'a'}, relations, params={'name': 'a'})
+    second = model._relationships({'name': 'b'}, relations, pagination=model.paginate({'page_size': 5}))
+    third = model._relationships({}, relations, fields=['age', 'name'])
+
+    assert relations == ['city']
+    # field selections are not part of the templates
+    assert len(Templated._pipeline_templates) == 1
+    assert third[-1] == {'$project': {'_id': True, 'age': True, 'name': True, 'city': True}}
+    assert first[0] == {'$match': {'name': 'a'}} and second[0] == {'$match': {'name': 'b'}}
+    # the lookup and projection stages are shared, the bound stages are not
+    assert first[1] is second[4] and first[2] is second[5]
+
+
+def test_relation_lookups():
+    class Post(BaseModel):
+        collection_name = 'posts'
+        fields = {'_id': Types.ObjectId, 'user_id': Types.ObjectId, 'token': Types.String}
+        protected_fields = ['token']
+
+    class Author(User):
+        relations = dict(User.relations, posts={
+            'type': Relations.hasMany,
+            'model': Post,
+            'localKey': '_id',
+            'foreignKey': 'user_id',
+            'sort': {'_id': -1},
+            'limit': 10,
+        })
+
+    # scalar keys are matched by $expr $eq, which uses the foreign key index
+    ag = Author({})._relationships({}, ['city', 'posts'])
+    assert ag[1]['$lookup'] == {
+        'from': 'cities',
+        'let': {'local_key': '$city_id'},
+        'pipeline': [
+            {'$match': {'$expr': {'$eq': ['$_id', '$$local_key']}, 'deleted_at': {'$exists': False}}},
+            {'$limit': 1},
+            {'$project': {'secret': False}},
+        ],
+        'as': 'city',
+    }
+    assert ag[2]['$lookup']['let'] == {'local_key': '$_id'}
+    assert ag[2]['$lookup']['pipeline'] == [
+        {'$match': {'$expr': {'$eq': ['$user_id', '$$local_key']}, 'deleted_at': {'$exists': False}}},
+        {'$sort': {'_id': -1}},
+        {'$limit': 10},
+        {'$project': {'token': False}},
+    ]
+    assert ag[3]['$project']['city'] == {'$arrayElemAt': ['$city', 0]}
+    assert ag[3]['$project']['posts'] is True
+
+    # keys holding lists keep the plain join, soft deleted documents are filtered after it
+    class Tagged(User):
+        relations = {'tagged': {'type': Relations.belongsToMany, 'model': Post, 'localKey': 'tags',
+                                'foreignKey': 'user_id', 'limit': 5}}
+
+    ag = Tagged({})._relationships({}, ['tagged'])
+    assert ag[1]['$lookup'] == {'from': 'posts', 'localField': 'tags', 'foreignField': 'user_id', 'as': 'tagged'}
+    assert ag[2]['$project']['tagged'] == {'$slice': [{'$filter': {
+        'input': '$tagged', 'as': 'related', 'cond': {'$eq': [{'$type': '$$related.deleted_at'}, 'missing']}
+    }}, 5]}
+
+    # sorting them needs a sub-pipeline, which cannot use an index before MongoDB 5.0
+    class SortedTagged(User):
+        relations = {'tagged': dict(Tagged.relations['tagged'], sort={'_id': 1})}
+
+    lookup = SortedTagged({})._relationships({}, ['tagged'])[1]['$lookup']
+    assert '$setIntersection' in lookup['pipeline'][0]['$match']['$expr']['$gt'][0]['$size']
+
+    # MongoDB 5.0+ accepts localField/foreignField with a pipeline
+    class ConciseTagged(SortedTagged):
+        concise_lookups = True
+
+    ag = ConciseTagged({})._relationships({}, ['tagged'])
+    assert (ag[1]['$lookup']['localField'], ag[1]['$lookup']['foreignField']) == ('tags', 'user_id')
+    assert ag[1]['$lookup']['pipeline'][0] == {'$match': {'deleted_at': {'$exists': False}}}
+    assert ag[2]['$project']['tagged'] is True
+
+
+def test_relation_window_before_lookups():
+    model = User({})
+    pagination = model.paginate({'page': 1, 'page_size': 5})
+    window = [{'$sort': {'_id': 1}}, {'$skip': 5}, {'$limit': 5}]
+
+    # only the page is joined when local fields select and sort the documents
+    ag = model._relationships({'name': 'a'}, ['city'], pagination=pagination)
+    assert ag[1:4] == window
+    assert '$lookup' in ag[4]
+
+    # dot notation filters and relation sort keys need the joined documents
+    ag = model._relationships({}, ['city'], pagination=pagination, params={'city.name': 'c'})
+    assert '$lookup' in ag[1]
+    assert ag[3:6] == [{'$match': {'city.name': 'c'}}] + window[:2]
+
+    pagination = model.paginate({'sort_desc': 'city.name', 'page_size': 5})
+    ag = model._relationships({}, ['city'], pagination=pagination)
+    assert '$lookup' in ag[1] and ag[3] == {'$sort': {'city.name': -1}}
+
+    # first() only joins one document
+    users = FakeCollection()
+    run(User({'users': users}).first({}, relations=['city']))
+    assert users.calls[0][1][0][1:4] == [{'$sort': {'_id': 1}}, {'$skip': 0}, {'$limit': 1}]
+
+
+def test_nested_relations():
+    class Country(BaseModel):
+        collection_name = 'countries'
+        fields = {'_id': Types.ObjectId, 'name': Types.String, 'code': Types.String}
+        protected_fields = ['code']
+
+    class Town(City):
+        fields = dict(City.fields, country_id=Types.ObjectId)
+        relations = {
+            'country': {'type': Relations.belongsTo, 'model': Country, 'localKey': 'country_id', 'foreignKey': '_id'},
+        }
+
+    class Resident(User):
+        relations = {
+            'city': dict(User.relations['city'], model=Town),
+        }
+
+    ag = Resident({})._relationships({}, ['city.country'])
+    pipeline = ag[1]['$lookup']['pipeline']
+    assert pipeline[2]['$lookup']['from'] == 'countries'
+    assert pipeline[2]['$lookup']['pipeline'][-1] == {'$project': {'code': False}}
+    assert pipeline[3] == {'$addFields': {'country': {'$arrayElemAt': ['$country', 0]}}}
+    assert ag[2]['$project']['city'] == {'$arrayElemAt': ['$city', 0]}
+
+    _id = ObjectId()
+    db = {
+        'users': FakeCollection([{'_id': _id, 'name': 'a', 'city_id': _id}]),
+        'cities': FakeCollection([{'_id': _id, 'name': 'c', 'secret': 's', 'country_id': _id}]),
+        'countries': FakeCollection([{'_id': _id, 'name': 'br', 'code': 'x'}]),
+    }
+    docs = run(Resident(db).find({}, relations=['city.country'], strategy=Strategies.batch))
+    assert docs[0]['city'] == {'_id': str(_id), 'name': 'c', 'country_id': str(_id),
+                               'country': {'_id': str(_id), 'name': 'br'}}
+    assert db['countries'].calls[0][1] == ({'_id': {'$in': [_id]}, 'deleted_at': {'$exists': False}},
+                                           {'code': False})
+
+
+def test_paged_facet():
+    _id = ObjectId()
+    users = FakeCollection([{'results': [{'_id': _id, 'password': 'x'}], 'count': [{'count': 7}]}])
+    model = User({'users': users})
+
+    paged = run(model.paged({'name': 'a'}, {'page': 1, 'page_size': 1}, []))
+    assert paged == {'results': [{'_id': str(_id)}], 'count': 7, 'page': 1, 'page_size': 1}
+
+    # the sort on local fields runs before $facet, where it can use an index
+    pipeline = users.calls[0][1][0]
+    assert len(pipeline) == 3
+    assert pipeline[0] == {'$match': {'name': 'a', 'deleted_at': {'$exists': False}}}
+    assert pipeline[1] == {'$sort': {'_id': 1}}
+    assert pipeline[2]['$facet']['count'] == [{'$count': 'count'}]
+    assert pipeline[2]['$facet']['results'][:2] == [{'$skip': 1}, {'$limit': 1}]
+
+    # sorted by a relation, the documents are joined first
+    users.docs = [{'results': [], 'count': []}]
+    run(model.paged({}, {'sort_desc': 'city.name'}, ['city']))
+    pipeline = users.calls[1][1][0]
+    assert len(pipeline) == 2 and {'$sort': {'city.name': -1}} in pipeline[1]['$facet']['results']
+
+
+def test_paged_concurrent():
+    _id = ObjectId()
+    users = FakeCollection(responses=[[{'_id': _id}], [{'count': 3}]])
+    model = User({'users': users})
+
+    paged = run(model.paged({'city.name': 'Recife'}, {}, ['city'], mode=User.PAGED_CONCURRENT))
+    assert paged['results'] == [{'_id': str(_id)}]
+    assert paged['count'] == 3
+
+    count_pipeline = users.calls[1][1][0]
+    assert count_pipeline[1]['$lookup']['from'] == 'cities'
+    assert {'$match': {'city.name': 'Recife'}} in count_pipeline
+    assert count_pipeline[-1] == {'$count': 'count'}
+
+
+def test_paged_keyset():
+    first_id, last_id = ObjectId(), ObjectId()
+    users = FakeCollection(responses=[
+        [{'_id': first_id, 'age': 1}, {'_id': last_id, 'age': 2}], [{'count': 3}],
+        [{'_id': ObjectId(), 'age': 3}], [{'count': 3}],
+    ])
+    model = User({'users': users})
+
+    paged = run(model.paged({}, {'page_size': 2, 'page': 5, 'sort_desc': 'age'}, [], after=''))
+    assert paged['page'] == 0
+    assert paged['count'] == 3
+    assert paged['next']
+    # $facet sub-pipelines cannot use indexes, keyset pages run the window at the top level
+    pipeline = users.calls[0][1][0]
+    assert not any('$facet' in stage for stage in pipeline)
+    assert pipeline[1:4] == [{'$sort': {'age': -1, '_id': -1}}, {'$skip': 0}, {'$limit': 2}]
+
+    paged = run(model.paged({}, {'page_size': 2, 'sort_desc': 'age', 'after': paged['next']}, []))
+    assert paged['next'] is None
+    pipeline = users.calls[2][1][0]
+    assert pipeline[1] == {'$match': {'$or': [
+        {'age': {'$lt': 2}},
+        {'age': None},
+        {'age': 2, '_id': {'$lt': last_id}},
+    ]}}
+    assert pipeline[2] == {'$sort': {'age': -1, '_id': -1}}
+
+    # null and missing values sort first and are never matched by a range
+    assert keyset_match({'age': 1, '_id': 1}, [None, last_id]) == {'$or': [
+        {'age': {'$ne': None}},
+        {'age': None, '_id': {'$gt': last_id}},
+    ]}
+    assert keyset_match({'age': -1, '_id': -1}, [None, last_id]) == {'age': None, '_id': {'$lt': last_id}}
+
+
+def test_keyset_token_with_fields():
+    last_id = ObjectId()
+    users = FakeCollection(responses=[
+        [{'_id': ObjectId(), 'name': 'a', 'age': 3}, {'_id': last_id, 'name': 'b', 'age': 2}], [{'count': 3}],
+    ])
+    model = User({'users': users})
+
+    paged = run(model.paged({}, {'page_size': 2, 'sort_desc': 'age'}, [], fields=['name'], after=''))
+    assert decode_token(paged['next']) == [2, last_id]
+    assert paged['results'][1] == {'_id': str(last_id), 'name': 'b'}
+    projects = [s['$project'] for s in users.calls[0][1][0] if '$project' in s]
+    assert projects[-1] == {'_id': True, 'name': True, 'age': True}
+
+
+def test_keyset_invalid_token():
+    with pytest.raises(InvalidPaginationToken):
+        User(None).paginate({'after': 'not a token'})
+    with pytest.raises(InvalidPaginationToken):
+        User(None).paginate({'after': encode_token([1, 2, 3])})
+
+
+def test_save_many():
+    events = []
+
+    class Audited(User):
+        hooks = [User.PRE_CREATE, User.POST_CREATE, User.POST_UPDATE]
+
+        async def pre_create(self):
+            events.append('pre_create')
+
+        async def post_create_many(self, model_ids, saved):
+            events.append(('post_create_many', model_ids, [doc['name'] for doc in saved]))
+
+        async def post_update(self, model_id, saved):
+            events.append(('post_update', model_id))
+
+    _id = ObjectId()
+    users = FakeCollection()
+    model = Audited({'users': users})
+
+    ids = run(model.save_many([{'name': 'a'}, {'_id': str(_id), 'name': 'b'}, {'name': 'c'}], batch_size=1))
+    assert len(ids) == 3
+    assert ids[1] == str(_id)
+    assert [call[0] for call in users.calls] == ['insert_many', 'insert_many', 'bulk_write']
+    assert users.calls[0][2] == {'ordered': False}
+    assert events == [
+        'pre_create',
+        'pre_create',
+        ('post_update', str(_id)),
+        ('post_create_many', [ids[0], ids[2]], ['a', 'c']),
+    ]
+
+    # a batch of one still goes to the *_many hooks
+    events.clear()
+    ids = run(model.save_many([{'name': 'd'}]))
+    assert events == ['pre_create', ('post_create_many', ids, ['d'])]
+
+
+def test_batch_relations():
+    class Traveler(User):
+        relations = dict(User.relations, visited={
+            'type': Relations.hasManyLocally,
+            'model': City,
+            'localKey': 'tags',
+            'foreignKey': '_id',
+            'strategy': Strategies.batch,
+        })
+
+    recife, natal = ObjectId(), ObjectId()
+    users = FakeCollection([
+        {'_id': ObjectId(), 'city_id': recife, 'tags': [natal, recife]},
+        {'_id': ObjectId(), 'city_id': natal, 'tags': []},
+    ])
+    cities = FakeCollection([
+        {'_id': recife, 'name': 'Recife', 'secret': 's'},
+        {'_id': natal, 'name': 'Natal'},
+    ])
+    model = Traveler({'users': users, 'cities': cities})
+
+    docs = run(model.find({}, relations=['city', 'visited'], strategy=Strategies.batch))
+    assert docs[0]['city'] == {'_id': str(recife), 'name': 'Recife'}
+    assert [c['name'] for c in docs[0]['visited']] == ['Natal', 'Recife']
+    assert docs[1]['city']['name'] == 'Natal'
+    assert docs[1]['visited'] == []
+
+    assert [call[0] for call in users.calls] == ['find']
+    assert [call[0] for call in cities.calls] == ['find', 'find']
+    assert cities.calls[0][1] == ({'_id': {'$in': [recife, natal]}, 'deleted_at': {'$exists': False}},
+                                  {'secret': False})
+    assert cities.calls[1][1][0]['deleted_at'] == {'$exists': False}
+
+    # local keys read only to load the relations are not returned
+    users.docs = [{'_id': recife, 'name': 'a', 'city_id': natal}]
+    docs = run(model.find({}, relations=['city'], fields=['name'], strategy=Strategies.batch))
+    assert users.calls[-1][1][1] == {'name': True, 'city_id': True}
+    assert docs == [{'_id': str(recife), 'name': 'a', 'city': {'_id': str(natal), 'name': 'Natal'}}]
+
+    # relations filtered with dot notation still need a $lookup
+    assert model._relation_strategies(['city', 'visited'], params={'city.name': 'Recife'}) == (['city'], ['visited'])
+
+
+def test_query_cache():
+    class CachedUser(User):
+        cache = QueryCache(max_entries=2)
+
+    _id = ObjectId()
+    users = FakeCollection([{'_id': _id, 'name': 'a'}])
+    cities = FakeCollection()
+    model = CachedUser({'users': users, 'cities': cities})
+
+    first = run(model.find({'name': 'a'}, relations=['city']))
+    first[0]['name'] = 'changed'
+    assert run(model.find({'name': 'a'}, relations=['city'])) == [{'_id': str(_id), 'name': 'a'}]
+    assert len(users.calls) == 1
+    assert CachedUser.cache.stats()['hits'] == 1
+
+    # writes on a related collection invalidate the entry
+    run(City({'cities': cities})._db_update_one({'_id': _id}, {'name': 'b'}))
+    run(model.find({'name': 'a'}, relations=['city']))
+    assert len(users.calls) == 2
+    assert CachedUser.cache.stats()['invalidations'] == 1
+
+
+def test_query_cache_eviction():
+    now = [0]
+    cache = QueryCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    cache.set('a', 1, ['users'])
+    cache.set('b', 2, ['users'])
+    assert cache.get('a') == 1
+    cache.set('c', 3, ['users'])
+    assert cache.get('b') is MISS
+    now[0] = 10
+    assert cache.get('a') is MISS
+    assert cache.stats()['evictions'] == 1
+
+
+def test_session_identity_map():
+    _id = ObjectId()
+    users = FakeCollection([{'_id': _id, 'name': 'a', 'password': 'x'}])
+    model = User({'users': users})
+
+    async def scenario():
+        async with odm.session() as identity_map:
+            first = await model.first({'_id': str(_id)})
+            again = await model.first({'_id': _id})
+            await model._db_update_one({'_id': _id}, {'name': 'b'})
+            updated = await model.first({'_id': str(_id)})
+            protected = await model.find({'_id': str(_id)}, True, force_fetch_protected_fields=['password'])
+        assert odm.current_session() is None
+        return first, again, updated, protected, identity_map
+
+    first, again, updated, protected, identity_map = run(scenario())
+    assert first == again == {'_id': str(_id), 'name': 'a'}
+    assert updated == {'_id': str(_id), 'name': 'b'}
+    # the entry was fetched without the protected field, it cannot serve this read
+    assert protected == {'_id': str(_id), 'name': 'a', 'password': 'x'}
+    assert [call[0] for call in users.calls] == ['find', 'update_one', 'find']
+    assert identity_map.hits == 2
+
+    run(model.first({'_id': str(_id)}))
+    assert len(users.calls) == 4
+
+    # streams of whole queries are not kept for the session
+    async def stream():
+        async with odm.session() as identity_map:
+            docs = [doc async for doc in model.stream({'name': 'a'})]
+        return docs, identity_map
+
+    docs, identity_map = run(stream())
+    assert len(docs) == 1 and identity_map.documents == {}
+
+
+def test_recommended_indexes():
+    class Post(BaseModel):
+        collection_name = 'posts'
+        fields = {'_id': Types.ObjectId, 'user_id': Types.ObjectId}
+        softDeletes = True
+
+    class Author(User):
+        indexes = [
+            {'keys': 'name', 'unique': True},
+            [('created_at', -1)],
+            IndexModel([('age', 1)], partialFilterExpression={'age': {'$gt': 18}}),
+        ]
+        relations = dict(User.relations, posts={
+            'type': Relations.hasMany,
+            'model': Post,
+            'localKey': '_id',
+            'foreignKey': 'user_id',
+        })
+
+    indexes = {
+        collection: [(index_keys(m), m.document.get('unique')) for m in models]
+        for collection, models in Author.recommended_indexes().items()
+    }
+    assert indexes == {
+        'users': [
+            ((('name', 1),), True),
+            ((('created_at', -1),), None),
+            ((('age', 1),), None),
+            ((('created_at', 1),), None),
+        ],
+        'posts': [((('user_id', 1),), None)],
+    }
+
+    created = run(Post({'posts': FakeCollection()}).ensure_indexes())
+    assert created == {'posts': ['deleted_at_1__id_1', 'deleted_at_1_created_at_1']}
+
+
+def test_search_modes():
+    class Searchable(User):
+        search_modes = {'name': SearchModes.text, 'password': SearchModes.substring}
+        fields = dict(User.fields, nickname=Types.String)
+
+    model = Searchable(None)
+    params = {'name': 'john doe', 'password': 'x', 'nickname': 'j.(', 'text_fields': 'name,password,nickname'}
+    query = model.filter(params)
+    assert query['$text'] == {'$search': 'john doe'}
+    assert 'name' not in query
+    assert query['password'] == {'$regex': '.*x.*', '$options': 'ig'}
+    assert query['nickname'] == {'$gte': 'j.(', '$lt': 'j.(\uffff'}
+    assert model.sort_query(params) == {'score': {'$meta': 'textScore'}}
+    assert model.sort_query(dict(params, sort_asc='age')) == {'age': 1}
+    assert model.sort_query({'name': 'john'}) == {'_id': 1}
+
+    # paged() sorts text searches by relevance too, keyset pages cannot seek on it
+    users = FakeCollection([{'results': [], 'count': []}])
+    run(Searchable({'users': users}).paged(params, {'page_size': 5}, []))
+    assert users.calls[0][1][0][1] == {'$sort': {'score': {'$meta': 'textScore'}}}
+    assert model.paginate({'after': ''}, params)['sort'] == {'_id': 1}
+
+    text_index = Searchable.recommended_indexes()['users'][0]
+    assert index_keys(text_index) == (('name', 'text'),)
+
+    # prefix searches are ranges run with the collation of their index
+    class Prefixed(User):
+        search_modes = {'name': SearchModes.prefix}
+
+    users = FakeCollection()
+    run(Prefixed({'users': users}).find({'name': 'joão', 'text_fields': 'name'}))
+    assert users.calls[0][1][0]['name'] == {'$gte': 'joão', '$lt': 'joão\uffff'}
+    assert users.calls[0][2]['collation'] == {'locale': 'pt', 'strength': 2}
+    run(Prefixed({'users': users}).find({'name': 'joão'}))
+    assert 'collation' not in users.calls[1][2]
+    # fields searched in the default mode have no collation index, nor any collation
+    run(User({'users': users}).find({'name': 'joão', 'text_fields': 'name'}))
+    assert users.calls[2][1][0]['name'] == {'$gte': 'joão', '$lt': 'joão\uffff'}
+    assert 'collation' not in users.calls[2][2]
+    prefix_index = Prefixed.recommended_indexes()['users'][0]
+    assert prefix_index.document['key'] == {'name': 1}
+    assert prefix_index.document['collation'] == {'locale': 'pt', 'strength': 2}
+
+
+def test_soft_remove():
+    class SoftUser(User):
+        softDeletes = True
+
+    _id = ObjectId()
+    users = FakeCollection()
+    model = SoftUser({'users': users})
+
+    assert run(model.remove(str(_id))) is True
+    name, (criteria, update), _ = users.calls[0]
+    assert name == 'update_one'
+    assert criteria == {'_id': _id, 'deleted_at': {'$exists': False}}
+    assert list(update['$set']) == ['deleted_at']
+
+    users.matched = 0
+    with pytest.raises(DocumentNotFound):
+        run(model.remove(str(_id)))
+
+    removed = []
+
+    class HookedUser(SoftUser):
+        hooks = [User.POST_DELETE]
+
+        async def post_delete(self, model_id, saved, softDeletes):
+            removed.append((model_id, saved))
+
+    users = FakeCollection([{'_id': _id, 'name': 'a', 'deleted_at': datetime(2020, 1, 1)}])
+    assert run(HookedUser({'users': users}).remove(_id)) is True
+    assert users.calls[0][0] == 'find_one_and_update'
+    assert users.calls[0][2]['projection'] == {'password': False}
+    assert removed == [(str(_id), {'_id': str(_id), 'name': 'a', 'deleted_at': '2020-01-01T00:00:00Z'})]
+
+
+def test_remove_many():
+    removed = []
+
+    class HookedUser(User):
+        softDeletes = True
+        hooks = [User.PRE_DELETE]
+
+        async def pre_delete_many(self, model_ids):
+            removed.extend(model_ids)
+
+    ids = [ObjectId(), ObjectId()]
+    users = FakeCollection([{'_id': _id} for _id in ids])
+    users.matched = 2
+
+    assert run(HookedUser({'users': users}).remove_many({'name': 'a', 'with_trashed': True})) == 2
+    assert users.calls[0][1] == ({'name': 'a', 'deleted_at': {'$exists': False}}, {'_id': True})
+    assert users.calls[1][0] == 'update_many'
+    assert users.calls[1][1][0] == {'_id': {'$in': ids}, 'deleted_at': {'$exists': False}}
+    assert removed == [str(_id) for _id in ids]
+
+
+def test_deferred_hooks():
+    events = []
+
+    class Indexed(User):
+        hooks = [User.POST_CREATE, User.POST_UPDATE]
+        deferred_hooks = [User.POST_CREATE]
+        hook_dispatcher = HookDispatcher(maxsize=10, batch_size=10)
+
+        async def post_create_many(self, model_ids, saved):
+            events.append(('post_create_many', len(model_ids), odm.current_session()))
+
+        async def post_update(self, model_id, saved):
+            events.append(('post_update', model_id))
+
+    _id = ObjectId()
+    model = Indexed({'users': FakeCollection()})
+
+    async def scenario():
+        async with odm.session():
+            await model.save_many([{'name': 'a'}, {'name': 'b'}, {'_id': str(_id)}])
+        # deferred hooks have not run yet, inline ones have
+        assert events == [('post_update', str(_id))]
+        await Indexed.hook_dispatcher.drain()
+
+    run(scenario())
+    # workers do not run in the session of the request that started them
+    assert events == [('post_update', str(_id)), ('post_create_many', 2, None)]
+    assert Indexed.hook_dispatcher.processed == 2
+    assert Indexed.hook_dispatcher.workers == []
+
+
+def test_watch():
+    class SoftUser(User):
+        softDeletes = True
+
+    _id = ObjectId()
+    deleted = {'_id': _id, 'name': 'a', 'password': 'x', 'deleted_at': datetime(2020, 1, 1)}
+    users = FakeCollection([
+        {'_id': {'t': 1}, 'operationType': 'insert', 'documentKey': {'_id': _id},
+         'fullDocument': {'_id': _id, 'name': 'a', 'password': 'x'}},
+        {'_id': {'t': 2}, 'operationType': 'update', 'documentKey': {'_id': _id},
+         'fullDocument': deleted, 'updateDescription': {'updatedFields': {'deleted_at': 1}}},
+        {'_id': {'t': 3}, 'operationType': 'update', 'documentKey': {'_id': _id},
+         'fullDocument': deleted, 'updateDescription': {'updatedFields': {'name': 'b'}}},
+        {'_id': {'t': 4}, 'operationType': 'delete', 'documentKey': {'_id': _id}},
+    ])
+    model = SoftUser({'users': users})
+
+    async def collect():
+        return [event async for event in model.watch({'name': 'a'}, resume_after={'t': 0})]
+
+    events = run(collect())
+    assert [(e['operation'], e['resume_token']) for e in events] == [
+        ('insert', {'t': 1}), ('delete', {'t': 2}), ('delete', {'t': 4})
+    ]
+    assert events[0]['document'] == {'_id': str(_id), 'name': 'a'}
+    assert events[2]['document'] is None
+
+    pipeline = users.calls[0][1][0]
+    assert pipeline == [
+        {'$match': {'$or': [{'operationType': 'delete'}, {'fullDocument.name': 'a'}]}},
+        {'$project': {'fullDocument.password': False}},
+    ]
+    assert users.calls[0][2] == {'full_document': 'updateLookup', 'resume_after': {'t': 0}}
+
+
+def test_instrumentation(caplog):
+    events = []
+    metrics = []
+
+    class Recorder(Instrumentation):
+        def end(self, event):
+            events.append(event)
+
+    class Instrumented(User):
+        softDeletes = True
+        hooks = [User.PRE_DELETE]
+        instrumentation = [
+            Recorder(),
+            SlowQueryLogger(threshold=0),
+            MetricsCallback(lambda name, value, labels: metrics.append((name, labels))),
+        ]
+
+    _id = ObjectId()
+    users = FakeCollection([{'_id': _id, 'name': 'a', 'city_id': _id, 'password': 'x'}])
+    cities = FakeCollection([{'_id': _id, 'name': 'c', 'secret': 's'}])
+    model = Instrumented({'users': users, 'cities': cities})
+
+    with caplog.at_level(logging.WARNING, logger='odm.slow_query'):
+        docs = run(model.find({'name': 'a', '$or': [{'age': 1}]}, relations=['city'], strategy=Strategies.batch))
+        run(model.remove(str(_id)))
+
+    assert docs[0]['city'] == {'_id': str(_id), 'name': 'c'}
+    find, remove = events
+    assert (find.collection, find.operation) == ('users', 'find')
+    assert find.shape == {'$or': [{'age': '?'}], 'name': '?'}
+    assert find.round_trips == 2
+    assert find.documents == 1
+    assert find.conversion_time > 0 and find.duration >= find.server_time
+    assert remove.shape == {'_id': '?'} and remove.hook_time > 0
+    assert 'slow find on users' in caplog.text
+    assert ('odm_operation_seconds', {'collection': 'users', 'operation': 'remove', 'status': 'ok'}) in metrics
+
+    # without listeners the operations emit nothing
+    run(User({'users': users}).find({}))
+    assert len(events) == 2
+
+
+def test_json_schema_validator():
+    def positive(instance, validator=None):
+        if instance <= 0:
+            raise ValueError('negativo')
+
+    schema = {
+        'type': 'object',
+        'properties': {
+            'name': {'type': 'string', 'minLength': 1, 'description': 'nome inválido'},
+            'age': {'type': 'integer', 'method': positive},
+            'owner': {'type': 'object_id'},
+            'tags': {'type': 'array', 'items': {'type': 'string'}},
+        },
+        'required': ['name'],
+        'additionalProperties': False,
+    }
+    validator = JsonSchemaValidator(schema, compiled=True)
+    assert validator.COMPILED is not None
+    assert JsonSchemaValidator(dict(schema)).VALIDATOR is validator.VALIDATOR
+    assert 'method' not in Draft4Validator.VALIDATORS
+
+    assert validator.validate({'name': 'a', 'age': 1, 'owner': ObjectId(), 'tags': ['x']})
+    for instance, message in [
+        ({'name': ''}, 'nome inválido'),
+        ({'name': 'a', 'age': 0}, "0 failed for 'positive': ValueError('negativo')"),
+        ({'name': 'a', 'owner': 'x'}, "'x' is not of type 'object_id'"),
+        ({'name': 'a', 'other': 1}, "Additional properties are not allowed ('other' was unexpected)"),
+    ]:
+        with pytest.raises(ValidationError) as e:
+            validator.validate(instance)
+        assert e.value.messages == [message]
+
+    # schemas using keywords the generated code does not support are validated by jsonschema only
+    assert JsonSchemaValidator({'anyOf': [{'type': 'string'}]}, compiled=True).COMPILED is None
+
+
+def test_validate_many():
+    schema = {
+        'type': 'object',
+        'properties': {'name': {'type': 'string', 'minLength': 1, 'description': 'nome inválido'},
+                       'tags': {'type': 'array', 'items': {'type': 'integer'}}},
+        'required': ['name'],
+    }
+    validator = JsonSchemaValidator(schema, compiled=True)
+    instances = [{'name': 'a'}, {'name': ''}, {'name': 'b', 'tags': [1, 'x']}, {'name': 'c'}, {}]
+
+    for errors in [
+        validator.validate_many(instances, workers=0),
+        validator.validate_many(instances, workers=2, chunk_size=2),
+        run(validator.validate_many_async(instances, workers=2, chunk_size=2)),
+    ]:
+        assert sorted(errors) == [1, 2, 4]
+        assert errors[1].messages == ['nome inválido'] and errors[1].paths == [['name']]
+        assert errors[2].paths == [['tags', 1]]
+        assert errors[4].messages == ["'name' is a required property"]
+
+    # the workers are started once and keep the validator between calls
+    pool = validator._pool(2)
+    assert validator._executor[1] is pool and validator._pool(2) is pool
+    validator.close()
+    assert validator._executor is None
+
+    # workers=0 and single chunks are validated in this process
+    def no_pool(workers=None):
+        raise AssertionError('process pool started')
+
+    validator._pool = no_pool
+    assert sorted(run(validator.validate_many_async(instances, workers=0, chunk_size=2))) == [1, 2, 4]
+    assert sorted(run(validator.validate_many_async(instances))) == [1, 2, 4]
+
+
+def test_validate_and_coerce():
+    class UserValidator(BaseValidator):
+        def __init__(self, params):
+            super().__init__(params)
+            self.rules = {
+                self.CREATE: self.from_model(User, required=['name'], missing=['_id']),
+                self.UPDATE: {
+                    'born': {'presence': self.OPTIONAL, 'format': 'datetime'},
+                    'age': {'presence': self.REQUIRED, 'format': 'integer'},
+                },
+            }
+
+        def validate_str(self, field, rule={}):
+            return field != 'root'
+
+    _id = ObjectId()
+    validator = UserValidator({'name': 'john', 'age': '30', 'city_id': str(_id), 'tags': [str(_id)], 'extra': 1})
+    doc = validator.validate_and_coerce(UserValidator.CREATE)
+    assert doc == {'name': 'john', 'age': 30, 'city_id': _id, 'tags': [_id], 'extra': 1}
+    assert len(UserValidator._rule_sets) == 1
+
+    users = FakeCollection()
+    run(User({'users': users}).save_many([doc], preparsed=True))
+    saved = users.calls[0][1][0][0]
+    assert saved['age'] == 30 and saved['city_id'] == _id and 'extra' not in saved
+
+    validator = UserValidator({'name': 'root', '_id': str(_id)})
+    assert validator.validate_and_coerce(UserValidator.CREATE) is None
+    assert validator.errors == ["Atributo '_id' não pode estar preenchido",
+                                "A string 'name' esta em um formato inválido"]
+
+    validator = UserValidator({'born': '2020-01-02T03:04:05', 'age': 'x'})
+    assert not validator.validate(UserValidator.UPDATE)
+    assert validator.errors == ["O inteiro 'age' esta em um formato inválido: x"]
+    doc = UserValidator({'born': '2020-01-02T03:04:05', 'age': 1}).validate_and_coerce(UserValidator.UPDATE)
+    assert doc == {'born': datetime(2020, 1, 2, 3, 4, 5), 'age': 1}
+
+    class Event(BaseModel):
+        fields = {'at': Types.ISODate, 'geo': 'Point'}
+        date_codec = DATEUTIL
+
+    class EventValidator(BaseValidator):
+        def __init__(self, params):
+            super().__init__(params)
+            self.rules = {self.CREATE: self.from_model(Event)}
+
+    assert 'geo' not in EventValidator.from_model(Event)
+    doc = EventValidator({'at': '2020-01-02T03:04:05+01:00'}).validate_and_coerce(EventValidator.CREATE)
+    assert doc['at'] == Event(None).preparse_fields({'at': '2020-01-02T03:04:05+01:00'})['at']
+    assert doc['at'].tzinfo is not None
+    EventValidator({'at': '2020-01-02T03:04:05'}).validate_and_coerce(EventValidator.CREATE)
+    assert len(EventValidator._rule_sets) == 1
+
+
+def test_date_codecs():
+    assert parse_iso('2020-01-02') == datetime(2020, 1, 2)
+    assert parse_iso('2020-01-02T03:04:05.123Z') == datetime(2020, 1, 2, 3, 4, 5, 123000)
+    assert parse_iso('2020-01-02T03:04:05-03:00') == datetime(2020, 1, 2, 6, 4, 5)
+    assert parse_iso('2020-02-30T00:00:00') is None
+    assert parse_iso('Jan 2 2020') is None
+    assert ISO.parse('Jan 2 2020 03:04 UTC') == datetime(2020, 1, 2, 3, 4)
+
+    aware = DATEUTIL.parse('2020-01-02T03:04:05+01:00')
+    assert ISO.format(aware) == '2020-01-02T02:04:05Z'
+
+    class Event(BaseModel):
+        fields = {'at': Types.ISODate}
+
+    class LegacyEvent(Event):
+        date_codec = DATEUTIL
+
+    query = Event(None).filter({'at': {'$gte': '2020-01-02T03:04:05Z', '$lt': datetime(2021, 1, 1)}})
+    assert query['at'] == {'$gte': datetime(2020, 1, 2, 3, 4, 5), '$lt': datetime(2021, 1, 1)}
+    assert LegacyEvent(None).filter({'at': '2020-01-02T03:04:05Z'})['at'].tzinfo is not None
+    assert Event(None).dict_rep({'at': aware}) == {'at': '2020-01-02T02:04:05Z'}
+
+
+def test_json_responses():
+    _id, city_id = ObjectId(), ObjectId()
+    doc = {
+        '_id': _id, 'name': 'a\u00e9"', 'age': 3, 'tags': [city_id], 'password': 'x', 'score': 1.5,
+        'created_at': datetime(2020, 1, 2, 3, 4, 5), 'city_id': city_id,
+        'city': {'_id': city_id, 'name': 'c', 'secret': 's'},
+    }
+    users = FakeCollection([doc])
+    model = User({'users': users})
+
+    def same(data, result):
+        assert json.loads(data.decode()) == json.loads(json.dumps(result, cls=ODMSerializer))
+
+    same(run(model.find_json({}, relations=['city'])), run(model.find({}, relations=['city'])))
+    same(run(model.find_json({}, force_fetch_protected_fields=['password', 'secret'])),
+         run(model.find({}, force_fetch_protected_fields=['password', 'secret'])))
+    data = run(model.find_json({}, force_single_result=True, relations=['city']))
+    assert json.loads(data.decode())['city'] == {'_id': str(city_id), 'name': 'c'}
+    assert b'password' not in data and b'secret' not in data
+    assert run(User({'users': FakeCollection()}).find_json({})) == b'null'
+
+    async def chunks(**kwargs):
+        return [chunk async for chunk in model.stream_json({}, **kwargs)]
+
+    users.docs = [doc, doc]
+    assert b''.join(run(chunks())) == run(model.find_json({}))
+    users.docs = []
+    assert run(chunks()) == [b'[]']
+
+    users.docs = [{'results': [doc], 'count': [{'count': 7}]}]
+    data = run(model.paged_json({}, {'page': 1, 'page_size': 1}, ['city']))
+    users.docs = [{'results': [doc], 'count': [{'count': 7}]}]
+    same(data, run(model.paged({}, {'page': 1, 'page_size': 1}, ['city'])))
+
+    # overridden dict_rep are still called
+    class Renamed(User):
+        def dict_rep(self, params):
+            return {'renamed': str(params['_id'])}
+
+    data = run(Renamed({'users': FakeCollection([doc])}).find_json({}, force_single_result=True))
+    assert json.loads(data.decode()) == {'renamed': str(_id)}
+
+    # a relation named like a field is written at the position of the field, like dict_rep does
+    class Resident(BaseModel):
+        collection_name = 'residents'
+        fields = {'_id': Types.ObjectId, 'city': Types.ObjectId, 'name': Types.String}
+        relations = {'city': dict(User.relations['city'], localKey='city')}
+
+    residents = FakeCollection([{'_id': _id, 'city': {'_id': city_id, 'name': 'c'}, 'name': 'n'}])
+    model = Resident({'residents': residents})
+    expected = json.dumps(run(model.find({}, relations=['city'])), cls=ODMSerializer, separators=(',', ':'))
+    assert run(model.find_json({}, relations=['city'])) == expected.encode()
+
+
 if __name__ == '__main__':
     pytest.main([__file__])